@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Latency benchmark of StplClient lookups against a local fake primuss backend.
+
+Usage:
+python benchmarks/client.py [--lookups 50] [--concurrency 10] [--latency 0.05] [--session-ttl 20]
+
+Reports the first lookup (including the login), single warm lookups and a batch of concurrent room calendar lookups
+sharing the session.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_primuss import FakePrimuss, add_tenant_arguments, tenant_from_args
+from mystundenplan.client import StplClient
+
+
+def ms(seconds):
+    return round(1000 * seconds, 2)
+
+
+async def run(args, server, tenant):
+    semester = tenant.semesters[-1]
+    class_ = tenant.classes[tenant.courses[0]][0]
+    async with StplClient(tenant.name, 'bench0', 'bench', login_url=server.login_url,
+                          limit=args.concurrency) as client:
+        start = time.perf_counter()
+        await client.get_class_calendar(semester, class_)
+        first = time.perf_counter() - start
+
+        warm = []
+        for i in range(args.lookups):
+            start = time.perf_counter()
+            await client.get_room_calendar(semester, tenant.rooms[i % len(tenant.rooms)])
+            warm.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[client.get_room_calendar(semester, room)
+                               for room in tenant.rooms[:args.lookups]])
+        batch = time.perf_counter() - start
+
+    return {
+        'first_lookup_ms': ms(first),
+        'warm_lookup_p50_ms': ms(statistics.median(warm)),
+        'warm_lookup_max_ms': ms(max(warm)),
+        'concurrent_lookups': min(args.lookups, len(tenant.rooms)),
+        'concurrent_total_ms': ms(batch),
+        'server_requests': server.requests,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_tenant_arguments(parser)
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--lookups', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=10, help='connection pool size')
+    args = parser.parse_args()
+
+    tenant = tenant_from_args(args)
+    server = FakePrimuss(('127.0.0.1', args.port), tenant, args.latency, args.error_rate, args.session_ttl,
+                         args.gzip)
+    server.start()
+    try:
+        print(json.dumps(asyncio.run(run(args, server, tenant)), indent=2))
+    finally:
+        server.shutdown()
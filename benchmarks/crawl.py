@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Crawl benchmark running StplSpider against a local fake primuss backend.
+
+Usage:
+python benchmarks/crawl.py --semesters 2 --courses 20 --classes 4 --rooms 100 [--all] [-a NAME=VALUE ...]
+    [-s NAME=VALUE ...]
+
+Distributed crawls share one backend started with fake_primuss.py, e.g. a coordinator and two workers:
+python benchmarks/crawl.py --login-url http://127.0.0.1:8080/stpl/login.php -s WORKQUEUE_PATH=queue.db
+python benchmarks/crawl.py --login-url http://127.0.0.1:8080/stpl/login.php -s WORKQUEUE_PATH=queue.db \
+    --first-account 1 -s WORKQUEUE_ROLE=worker
+
+Reports requests/sec, items/sec, peak RSS, the CPU time spent in each spider callback and when the last class or room
+calendar of the current semester was scraped (current_calendars_s).
+"""
+import argparse
+import json
+import os
+import resource
+import sys
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scrapy import signals
+from scrapy.crawler import CrawlerProcess
+from scrapy.settings import Settings
+from fake_primuss import FakePrimuss, add_tenant_arguments, tenant_from_args
+from mystundenplan import settings as project_settings
+from mystundenplan.items import Download
+from mystundenplan.spiders.schedule import StplSpider
+
+# the calendars served from the current semester, current_calendars_s reports when the last of them was scraped
+CURRENT_CALENDARS = ('classCalendarJson', 'locationCalendarJson')
+
+
+class CallbackTimer(object):
+    """Spider middleware measuring the CPU time spent in each callback, including lazy generator evaluation."""
+
+    cpu = defaultdict(float)
+    calls = defaultdict(int)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls()
+
+    def process_spider_output(self, response, result, spider=None):
+        name = getattr(response.request.callback, '__name__', 'parse')
+        self.calls[name] += 1
+        result = iter(result)
+        while True:
+            started = time.process_time()
+            try:
+                i = next(result)
+            except StopIteration:
+                self.cpu[name] += time.process_time() - started
+                return
+            self.cpu[name] += time.process_time() - started
+            yield i
+
+    async def process_spider_output_async(self, response, result, spider=None):
+        name = getattr(response.request.callback, '__name__', 'parse')
+        self.calls[name] += 1
+        result = result.__aiter__()
+        while True:
+            started = time.process_time()
+            try:
+                i = await result.__anext__()
+            except StopAsyncIteration:
+                self.cpu[name] += time.process_time() - started
+                return
+            self.cpu[name] += time.process_time() - started
+            yield i
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run(args):
+    server = None
+    if args.login_url is None:
+        server = FakePrimuss(('127.0.0.1', args.port), tenant_from_args(args), args.latency, args.error_rate,
+                             args.session_ttl, args.gzip)
+        server.start()
+
+    settings = Settings()
+    settings.setmodule(project_settings, priority='project')
+    settings.set('LOG_LEVEL', args.log_level)
+    spider_middlewares = settings.getdict('SPIDER_MIDDLEWARES')
+    spider_middlewares['__main__.CallbackTimer'] = 999
+    settings.set('SPIDER_MIDDLEWARES', spider_middlewares)
+    for option in args.set:
+        name, value = option.split('=', 1)
+        settings.set(name, value, priority='cmdline')
+
+    process = CrawlerProcess(settings)
+    crawler = process.create_crawler(StplSpider)
+    timings = {}
+    current = server.tenant.semesters[-1] if server is not None else None
+
+    def spider_opened():
+        timings['opened'] = time.perf_counter()
+
+    def spider_closed():
+        timings['closed'] = time.perf_counter()
+
+    def item_scraped(item):
+        meta = item.get('meta') if isinstance(item, Download) else None
+        if meta is not None and meta.name in CURRENT_CALENDARS and meta.context.get('semester') == current:
+            timings['current_calendars'] = time.perf_counter()
+
+    crawler.signals.connect(spider_opened, signal=signals.spider_opened)
+    crawler.signals.connect(spider_closed, signal=signals.spider_closed)
+    crawler.signals.connect(item_scraped, signal=signals.item_scraped)
+
+    rss_before = peak_rss_mb()
+    spider_args = dict(option.split('=', 1) for option in args.arg)
+    accounts = [(args.tenant, 'bench%d' % i, 'bench') for i in range(args.first_account,
+                                                                      args.first_account + args.accounts)]
+    process.crawl(crawler, accounts=accounts, all=args.all, login_url=args.login_url or server.login_url,
+                  allowed_domains=['127.0.0.1'], **spider_args)
+    process.start()
+    if server is not None:
+        server.shutdown()
+
+    stats = crawler.stats.get_stats()
+    elapsed = timings['closed'] - timings['opened']
+    responses = stats.get('downloader/response_count', 0)
+    items = stats.get('item_scraped_count', 0)
+    return {
+        'elapsed_s': round(elapsed, 3),
+        'requests': responses,
+        'server_requests': server.requests if server is not None else None,
+        'items': items,
+        'requests_per_s': round(responses / elapsed, 1),
+        'items_per_s': round(items / elapsed, 1),
+        'current_calendars_s': round(timings['current_calendars'] - timings['opened'], 3)
+        if 'current_calendars' in timings else None,
+        'peak_rss_mb': round(max(peak_rss_mb(), rss_before), 1),
+        'callbacks': {name: {'calls': CallbackTimer.calls[name], 'cpu_s': round(CallbackTimer.cpu[name], 4),
+                             'cpu_ms_per_call': round(1000 * CallbackTimer.cpu[name] / CallbackTimer.calls[name], 3)}
+                      for name in sorted(CallbackTimer.calls)},
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_tenant_arguments(parser)
+    parser.add_argument('--port', type=int, default=0, help='fixed server port, e.g. to replay a cached crawl')
+    parser.add_argument('--login-url', help='crawl a running fake backend (fake_primuss.py) instead of starting one')
+    parser.add_argument('--all', action='store_true', help='crawl all semesters')
+    parser.add_argument('--accounts', type=int, default=1, help='number of accounts crawled in one process')
+    parser.add_argument('--first-account', type=int, default=0,
+                        help='number of the first account, give each process of a distributed crawl its own')
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('-a', '--arg', action='append', default=[], metavar='NAME=VALUE',
+                        help='pass a spider argument')
+    parser.add_argument('-s', '--set', action='append', default=[], metavar='NAME=VALUE',
+                        help='override a scrapy setting')
+    print(json.dumps(run(parser.parse_args()), indent=2))
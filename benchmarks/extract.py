@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of the HTML extraction against the saved pages in benchmarks/fixtures.
+
+Usage:
+python benchmarks/extract.py [--number 200]
+python benchmarks/extract.py --update   # regenerate the fixtures from the fake backend
+
+Compares mystundenplan.extract with the former extraction building a full Selector per page and running each query
+separately, and checks that both return the same data.
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from parsel import Selector
+from fake_primuss import Tenant
+from mystundenplan import extract
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def selector_index_html(text):
+    html_data = Selector(text=text)
+    courses = html_data.css("#cbstg > option:not(:first-child)").css('::attr(value)').extract()
+    html_data.css("#cbraum > option:not(:first-child)").css("::attr(value)").extract()
+
+    stundenraster = []
+    for line in html_data.css('head > script:last_child::text').re(r'stundenraster\[\d+\] = \[(.*)\];'):
+        m = re.fullmatch(r'\'(?P<starts>\d{2}.\d{2})\', \'(?P<ends>\d{2}.\d{2})\', \'(?P<slot>\d+)\'', line)
+        if m:
+            stundenraster.append({'slot': m.group('slot'), 'starts': m.group('starts'), 'ends': m.group('ends'), })
+
+    cbraum = []
+    for (i, element) in enumerate(html_data.css("#cbraum > option:not(:first-child)")):
+        cbraum.append({
+            'id': element.css('::attr(value)').extract_first(),
+            'title': element.css('::attr(title)').extract_first(),
+            'name': element.css('::text').extract_first()
+        })
+
+    js_variables = html_data.css('head > script:last_child::text')
+    data = {
+        'title': html_data.css('head > title::text').extract_first(),
+        'indexLink': js_variables.re_first(r'indexLink = \'(.*)\';'),
+        'frontendDir': js_variables.re_first(r'frontendDir = \'(.*)\';'),
+        'stplIndexLink': js_variables.re_first(r'STPL.IndexLink = \'(.*)\';'),
+        'vorlesungsanfang': js_variables.re_first(r'Vorlesungsanfang = \'(.*)\';'),
+        'vorlesungsende': js_variables.re_first(r'Vorlesungsende = \'(.*)\';'),
+        'semesteranfang': js_variables.re_first(r'Semesteranfang = \'(.*)\';'),
+        'semesterende': js_variables.re_first(r'Semesterende = \'(.*)\';'),
+        'stundenraster': stundenraster,
+        'cbraum': cbraum
+    }
+    return data, courses
+
+
+def selector_personal_calendar_html(text):
+    html_data = Selector(text=text)
+    return {'title': html_data.css('#content_title > h2::text').extract_first()}
+
+
+def selector_class_calendar_html(text):
+    html_data = Selector(text=text)
+    return {
+        'title': html_data.css('#content_title > h2::text').extract_first(),
+        'subtitle': html_data.css('#content_subtitle > div::text').extract_first()
+    }
+
+
+def selector_location_calendar_html(text):
+    html_data = Selector(text=text)
+    return {
+        'title': html_data.css('#content_title > h2::text').extract_first(),
+        'subtitle': html_data.css('#content_subtitle > div > div:nth-child(1)::text').extract_first(),
+        'description': html_data.css('#content_subtitle > div > div:nth-child(2)::text').re_first(
+            r'Beschreibung: (.*)$'),
+        'type': html_data.css('#content_subtitle > div > div:nth-child(3)::text').re_first(r'Raumtyp: (.*)$')
+    }
+
+
+PAGES = [
+    ('indexHtml', selector_index_html, extract.index_html),
+    ('personalCalendarHtml', selector_personal_calendar_html, extract.personal_calendar_html),
+    ('classCalendarHtml', selector_class_calendar_html, extract.class_calendar_html),
+    ('locationCalendarHtml', selector_location_calendar_html, extract.location_calendar_html),
+]
+
+
+def fixture_path(name):
+    return os.path.join(FIXTURES, '%s.html' % name)
+
+
+def update_fixtures():
+    """Writes the pages of a large synthetic tenant, with a full week of lectures in each grid."""
+    tenant = Tenant(courses=60, classes=4, rooms=400, lectures=20, weeks=1)
+    semester = tenant.semesters[-1]
+    class_ = tenant.classes[tenant.courses[0]][0]
+    room = tenant.rooms[0]
+    pages = {
+        'indexHtml': tenant.index_html(semester),
+        'personalCalendarHtml': tenant.grid_html('Personal', '<div>bench0</div>', semester, class_=class_),
+        'classCalendarHtml': tenant.grid_html('Class %s' % class_, '<div>Semester %s</div>' % semester, semester,
+                                              class_=class_),
+        'locationCalendarHtml': tenant.grid_html(
+            'Room %s' % room, '<div><div>Room %s</div><div>Beschreibung: Seminar room %s</div>'
+                              '<div>Raumtyp: Seminar</div></div>' % (room, room), semester, room=room),
+    }
+    os.makedirs(FIXTURES, exist_ok=True)
+    for (name, text) in pages.items():
+        with open(fixture_path(name), 'w', encoding='utf-8') as f:
+            f.write(text)
+
+
+def run(args):
+    results = {}
+    for (name, baseline, fast) in PAGES:
+        with open(fixture_path(name), encoding='utf-8') as f:
+            text = f.read()
+        if baseline(text) != fast(text):
+            raise AssertionError('%s: extraction differs from the baseline' % name)
+
+        baseline_s = min(timeit.repeat(lambda: baseline(text), number=args.number, repeat=args.repeat))
+        fast_s = min(timeit.repeat(lambda: fast(text), number=args.number, repeat=args.repeat))
+        results[name] = {
+            'bytes': len(text.encode('utf-8')),
+            'selector_ms': round(1000 * baseline_s / args.number, 3),
+            'extract_ms': round(1000 * fast_s / args.number, 3),
+            'speedup': round(baseline_s / fast_s, 2),
+        }
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--number', type=int, default=200, help='calls per timing')
+    parser.add_argument('--repeat', type=int, default=5, help='timings per page, the fastest is reported')
+    parser.add_argument('--update', action='store_true', help='regenerate the fixtures')
+    args = parser.parse_args()
+
+    if args.update:
+        update_fixtures()
+    print(json.dumps(run(args), indent=2))
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"""
+Local fake of the primuss myStundenplan backend serving a synthetic tenant.
+
+Usage:
+python benchmarks/fake_primuss.py --port 8080 --semesters 2 --courses 10 --classes 4 --rooms 50
+
+Point the spider at it with -a login_url=http://127.0.0.1:8080/stpl/login.php -a allowed_domains=127.0.0.1
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import random
+import threading
+import time
+from collections import Counter, namedtuple
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+Lecture = namedtuple('Lecture', ['id', 'title', 'starts', 'ends', 'room', 'classes'])
+
+SLOTS = [('08.15', '09.45'), ('10.00', '11.30'), ('11.45', '13.15'), ('14.00', '15.30'), ('15.45', '17.15'),
+         ('17.30', '19.00')]
+
+
+class Tenant(object):
+    """Synthetic tenant with a deterministic set of semesters, courses, classes, rooms and lectures."""
+
+    def __init__(self, name='fhin', semesters=2, courses=10, classes=4, rooms=50, lectures=8, weeks=2):
+        self.name = name
+        self.semesters = ['%s' % (20 + i) for i in range(semesters)]
+        self.courses = ['%s' % (100 + i) for i in range(courses)]
+        self.rooms = ['%s' % (1000 + i) for i in range(rooms)]
+        self.lectures = {}
+
+        # classes are shared between neighbouring courses to mimic overlapping groups
+        self.classes = {}
+        for (i, course) in enumerate(self.courses):
+            own = ['%s%02d' % (course, j) for j in range(classes)]
+            shared = ['%s%02d' % (self.courses[i - 1], 0)] if i > 0 else []
+            self.classes[course] = own + shared
+
+        for semester in self.semesters:
+            monday = date(2000 + int(semester) // 2, 3 if int(semester) % 2 == 0 else 10, 1)
+            monday -= timedelta(days=monday.weekday())
+            semester_lectures = []
+            for course in self.courses:
+                for class_ in self.classes[course][:classes]:
+                    for n in range(lectures):
+                        for week in range(weeks):
+                            day = monday + timedelta(days=7 * week + n % 5)
+                            starts, ends = SLOTS[(n + int(class_)) % len(SLOTS)]
+                            room = self.rooms[(n * 7 + int(class_)) % len(self.rooms)]
+                            semester_lectures.append(Lecture(
+                                '%s-%s-%d-%d' % (semester, class_, n, week), 'Lecture %s/%d' % (class_, n),
+                                '%s %s' % (day.strftime('%m/%d/%Y'), starts.replace('.', ':')),
+                                '%s %s' % (day.strftime('%m/%d/%Y'), ends.replace('.', ':')), room, [class_]))
+            self.lectures[semester] = semester_lectures
+
+    def semester_json(self):
+        return [{'id': s, 'name': 'Semester %s' % s, 'isaktuelles': s == self.semesters[-1]} for s in self.semesters]
+
+    def course_json(self, course):
+        return {'0': [{'studiengruppen_id': c, 'studiengruppe': 'Class %s' % c} for c in self.classes.get(course, [])]}
+
+    def course_selection_json(self):
+        classes = [c for course in self.courses for c in self.classes[course]]
+        return {'fak': {'stg': {'sem': {'grp': {'lv': {c: {'studiengruppen_id': c} for c in classes}}}}}}
+
+    def class_selection_json(self, class_):
+        return {'studiengruppen_id': class_, 'faecher': ['Lecture %s/%d' % (class_, n) for n in range(4)]}
+
+    def calendar_json(self, semester, class_=None, room=None):
+        events = [[l.id, l.title, l.starts, l.ends, 0, 0, 0, 1, 0, 'Room %s' % l.room, ','.join(l.classes)]
+                  for l in self.lectures.get(semester, [])
+                  if (class_ is None or class_ in l.classes) and (room is None or l.room == room)]
+        if class_ is None and room is None:
+            events = events[:20]
+        return {'events': events, 'issort': True, 'start': '', 'end': '', 'error': None}
+
+    def index_html(self, semester):
+        stundenraster = '\n'.join("stundenraster[%d] = ['%s', '%s', '%d'];" % (i, s, e, i + 1)
+                                  for (i, (s, e)) in enumerate(SLOTS))
+        courses = ''.join('<option value="%s">Course %s</option>' % (c, c) for c in self.courses)
+        rooms = ''.join('<option value="%s" title="Room %s (Seminar)">Room %s</option>' % (r, r, r) for r in self.rooms)
+        return ('<html><head><title>myStundenplan</title><script src="x.js"></script><script>\n'
+                "var stundenraster = [];\n%s\nindexLink = 'index.php';\nfrontendDir = 'frontend';\n"
+                "STPL.IndexLink = 'index.php?FH=%s';\nVorlesungsanfang = '01.10.%s';\nVorlesungsende = '31.01.%s';\n"
+                "Semesteranfang = '01.10.%s';\nSemesterende = '28.02.%s';\n</script></head><body>"
+                '<select id="cbsem"><option value="%s">%s</option></select>'
+                '<select id="cbstg"><option value="-1">Studiengang</option>%s</select>'
+                '<select id="cbraum"><option value="-1">Raum</option>%s</select>'
+                '</body></html>') % (stundenraster, self.name, semester, semester, semester, semester, semester,
+                                     semester, courses, rooms)
+
+    def grid_html(self, title, subtitle, semester=None, class_=None, room=None):
+        cells = {}
+        for l in self.lectures.get(semester, []):
+            if (class_ is not None and class_ in l.classes) or (room is not None and l.room == room):
+                starts = datetime.strptime(l.starts, '%m/%d/%Y %H:%M')
+                cells.setdefault((starts.strftime('%H.%M'), starts.weekday()), []).append(l)
+
+        rows = []
+        for (starts, ends) in SLOTS:
+            row = ['<td class="slot">%s - %s</td>' % (starts, ends)]
+            for day in range(5):
+                row.append('<td class="cell">%s</td>' % ''.join(
+                    '<div class="lecture" title="%s"><span class="title">%s</span><span class="room">Room %s</span>'
+                    '</div>' % (l.id, l.title, l.room) for l in cells.get((starts, day), [])))
+            rows.append('<tr>%s</tr>' % ''.join(row))
+        return ('<html><head><title>myStundenplan</title></head><body><div id="content_title"><h2>%s</h2></div>'
+                '<div id="content_subtitle">%s</div><table class="grid">%s</table></body></html>') % (
+            title, subtitle, ''.join(rows))
+
+
+class FakePrimuss(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, tenant, latency=0.0, error_rate=0.0, session_ttl=0, gzip=False):
+        super(FakePrimuss, self).__init__(address, Handler)
+        self.tenant = tenant
+        self.latency = latency
+        self.error_rate = error_rate
+        self.session_ttl = session_ttl
+        self.gzip = gzip
+        self.session_requests = Counter()
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    @property
+    def login_url(self):
+        return 'http://%s:%s/stpl/login.php' % self.server_address[:2]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request({})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.handle_request(parse_qs(self.rfile.read(length).decode('utf-8')))
+
+    def handle_request(self, form):
+        with self.server.lock:
+            self.server.requests += 1
+
+        url = urlparse(self.path)
+        params = {k: v[0] for (k, v) in parse_qs(url.query).items()}
+        params.update({k: v[0] for (k, v) in form.items()})
+
+        if url.path == '/stpl/login.php':
+            return self.login(params)
+        if url.path != '/stpl/index.php':
+            return self.send(404, 'text/plain', 'not found')
+        if self.server.latency:
+            # cbGrid and index pages are rendered server side and a lot slower than the JSON endpoints
+            time.sleep(self.server.latency * (1 if params.get('mode') not in (None, 'cbGrid') else 4))
+        if random.random() < self.server.error_rate:
+            return self.send(503, 'text/plain', 'overloaded')
+        if self.server.sessions.get(params.get('User')) != params.get('Session'):
+            return self.send(200, 'text/html', '<html><body><form action="login.php" method="post">'
+                                               '<input type="text" name="user"><input type="password" name="pwd">'
+                                               '</form></body></html>')
+        if self.server.session_ttl:
+            with self.server.lock:
+                self.server.session_requests[params['User']] += 1
+                if self.server.session_requests[params['User']] > self.server.session_ttl:
+                    del self.server.sessions[params['User']]
+                    return self.send(302, 'text/html', '', {'Location': '/stpl/login.php'})
+        self.route(params)
+
+    def login(self, params):
+        user = params.get('user')
+        session = hashlib.sha1(('%s:%s' % (user, self.server.requests)).encode('utf-8')).hexdigest()
+        with self.server.lock:
+            self.server.sessions[user] = session
+            self.server.session_requests[user] = 0
+        location = '/stpl/index.php?%s' % urlencode({'FH': params.get('FH'), 'Lang': 'de', 'User': user,
+                                                      'Session': session})
+        self.send_response(302)
+        self.send_header('Location', location)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def route(self, params):
+        tenant = self.server.tenant
+        mode = params.get('mode')
+        semester = params.get('sem')
+
+        if mode is None and semester is None:
+            return self.send_html(tenant.index_html(tenant.semesters[-1]))
+        if mode is None:
+            return self.send_html(tenant.index_html(semester))
+        if mode == 'cbsem':
+            return self.send_json(tenant.semester_json())
+        if mode == 'cbstg':
+            return self.send_json(tenant.course_json(params.get('stg')))
+        if mode == 'faecherauswahlstg':
+            return self.send_json(tenant.course_selection_json())
+        if mode == 'faecherauswahllv':
+            return self.send_json(tenant.class_selection_json(params.get('faecherauswahlstgru')))
+        if mode == 'calendar':
+            return self.send_json(tenant.calendar_json(semester, params.get('stgru'), params.get('raum')))
+        if mode == 'cbGrid':
+            if 'raum' in params:
+                room = params['raum']
+                subtitle = ('<div><div>Room %s</div><div>Beschreibung: Seminar room %s</div><div>Raumtyp: Seminar</div>'
+                            '</div>') % (room, room)
+                return self.send_html(tenant.grid_html('Room %s' % room, subtitle, semester, room=room))
+            if 'stgru' in params:
+                class_ = params['stgru']
+                return self.send_html(tenant.grid_html('Class %s' % class_, '<div>Semester %s</div>' % semester,
+                                                       semester, class_=class_))
+            return self.send_html(tenant.grid_html('Personal', '<div>%s</div>' % params.get('User'), semester,
+                                                   class_=tenant.classes[tenant.courses[0]][0]))
+        self.send(400, 'text/plain', 'unknown mode')
+
+    def send_html(self, html):
+        self.send(200, 'text/html; charset=utf-8', html)
+
+    def send_json(self, data):
+        self.send(200, 'application/json; charset=utf-8', json.dumps(data))
+
+    def send(self, status, content_type, text, headers=None):
+        body = text.encode('utf-8')
+        headers = dict(headers or {})
+        if self.server.gzip and body and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            headers['Content-Encoding'] = 'gzip'
+        self.send_response(status)
+        for (name, value) in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def add_tenant_arguments(parser):
+    parser.add_argument('--tenant', default='fhin')
+    parser.add_argument('--semesters', type=int, default=2)
+    parser.add_argument('--courses', type=int, default=10)
+    parser.add_argument('--classes', type=int, default=4)
+    parser.add_argument('--rooms', type=int, default=50)
+    parser.add_argument('--lectures', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to each JSON response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with 503')
+    parser.add_argument('--session-ttl', type=int, default=0, help='requests after which a session expires')
+    parser.add_argument('--gzip', action='store_true', help='gzip responses of clients accepting it')
+
+
+def tenant_from_args(args):
+    return Tenant(args.tenant, args.semesters, args.courses, args.classes, args.rooms, args.lectures)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8080)
+    add_tenant_arguments(parser)
+    args = parser.parse_args()
+
+    server = FakePrimuss(('127.0.0.1', args.port), tenant_from_args(args), args.latency, args.error_rate,
+                         args.session_ttl, args.gzip)
+    print('Serving fake primuss on %s' % server.login_url)
+    server.serve_forever()
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of the Download item representation.
+
+Usage:
+python benchmarks/items.py [--items 50000]
+
+Builds the downloads of a large crawl (location calendars of many rooms over several semesters, the bulk of the items)
+once as the former items holding a dict copy of Meta with a context of per-response strings, and once as the current
+items holding the Meta of the response with interned context values. Reports the memory held by the items, the time
+to build them and the time to export them as JSON lines, and checks that both export the same lines.
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import scrapy
+from scrapy.exporters import JsonLinesItemExporter
+from mystundenplan.items import Download
+from mystundenplan.spiders.session import Meta, SessionSpider, Session
+
+
+class DictDownload(scrapy.Item):
+    meta = scrapy.Field()
+    data = scrapy.Field()
+
+
+def former_meta(session, name, context):
+    meta_context = {'tenant': session.fh}
+    meta_context.update(context)
+    return Meta('%s(%s)' % (name, meta_context), name, meta_context)
+
+
+def contexts(count):
+    """Contexts as parsed from the responses, each value a string object of its own."""
+    for i in range(count):
+        yield json.loads('{"semester": "%d", "location": "%d"}' % (20 + i % 4, 1000 + i // 4))
+
+
+def build(count, lean):
+    spider = SessionSpider.__new__(SessionSpider)
+    spider.sessions = {'fhin:user': Session('http://localhost/', json.loads('"fhin"'), 'de', 'user', 'session')}
+    data = {'events': []}
+    items = []
+    for context in contexts(count):
+        if lean:
+            items.append(Download(meta=spider.meta('fhin:user', 'locationCalendarJson', context), data=data))
+        else:
+            meta = former_meta(spider.sessions['fhin:user'], 'locationCalendarJson', context)
+            items.append(DictDownload(meta=meta._asdict(), data=data))
+    return items
+
+
+def export(items):
+    f = io.BytesIO()
+    exporter = JsonLinesItemExporter(f)
+    exporter.start_exporting()
+    for item in items:
+        exporter.export_item(item)
+    exporter.finish_exporting()
+    return f.getvalue()
+
+
+def measure(count, lean, repeat):
+    tracemalloc.start()
+    items = build(count, lean)
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    build_s = min(timeit.repeat(lambda: build(count, lean), number=1, repeat=repeat))
+    export_s = min(timeit.repeat(lambda: export(items), number=1, repeat=repeat))
+    return export(items), {
+        'held_mb': round(held / 1048576.0, 2),
+        'bytes_per_item': held // count,
+        'build_ms': round(1000 * build_s, 1),
+        'export_ms': round(1000 * export_s, 1),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, default=50000, help='downloads to build')
+    parser.add_argument('--repeat', type=int, default=3, help='timings of each step, the fastest is reported')
+    args = parser.parse_args()
+
+    former_lines, former = measure(args.items, False, args.repeat)
+    lean_lines, lean = measure(args.items, True, args.repeat)
+    if former_lines != lean_lines:
+        raise AssertionError('exports differ')
+    print(json.dumps({'former': former, 'lean': lean}, indent=2))
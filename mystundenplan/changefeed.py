@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import json
+import sqlite3
+import zlib
+from mystundenplan.events import INTERNED, parse_event, parse_events
+
+EVENT_FIELDS = ['title', 'starts', 'ends', 'location']
+
+
+def calendar_events(data, tenant, semester, interned):
+    """Parses the events of a calendar payload, resolving interned event keys through interned (key -> entry)."""
+    if isinstance(data, dict) and INTERNED in data:
+        return [e for e in (parse_event(interned[key], tenant, semester) for key in data[INTERNED] if key in interned)
+                if e is not None]
+    return list(parse_events(data, tenant, semester))
+
+
+def calendar_snapshot(events):
+    """
+    Returns {identity: [title, starts, ends, location]} of a calendar. Events are identified by their calendar id while
+    it is unique within the calendar, so a moved room or time shows up as modification, otherwise by their event key.
+    """
+    ids = [e.id for e in events]
+    by_id = None not in ids and len(set(ids)) == len(ids)
+    return {str(e.id) if by_id else e.key: [e.title, e.starts, e.ends, e.location] for e in events}
+
+
+def diff_calendar(before, after):
+    """Yields (op, identity, changes) for the events added, removed or modified between two calendar snapshots."""
+    for identity in sorted(set(before) | set(after)):
+        old, new = before.get(identity), after.get(identity)
+        if old is None:
+            yield 'added', identity, dict(zip(EVENT_FIELDS, new))
+        elif new is None:
+            yield 'removed', identity, dict(zip(EVENT_FIELDS, old))
+        elif old != new:
+            yield 'modified', identity, {f: [o, n] for (f, o, n) in zip(EVENT_FIELDS, old, new) if o != n}
+
+
+def diff_data(before, after):
+    """Returns the changed top-level keys of two dict payloads as {key: [before, after]}, None for other payloads."""
+    if not (isinstance(before, dict) and isinstance(after, dict)):
+        return None
+    return {k: [before.get(k), after.get(k)] for k in sorted(set(before) | set(after)) if before.get(k) != after.get(k)}
+
+
+class ChangeFeedStore(object):
+    """
+    SQLite store of the last snapshot per Meta.id: the events of calendar downloads (see calendar_snapshot) and the
+    payload of all others, together with the scope (tenant, semester, username) a download belongs to.
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS snapshots ('
+                                'id TEXT PRIMARY KEY, name TEXT, context TEXT, tenant TEXT, semester TEXT, '
+                                'username TEXT, data BLOB)')
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def get(self, id_):
+        row = self.connection.execute('SELECT data FROM snapshots WHERE id = ?', (id_,)).fetchone()
+        return json.loads(zlib.decompress(row[0])) if row is not None else None
+
+    def put(self, meta, data):
+        context = meta.context
+        self.connection.execute('INSERT OR REPLACE INTO snapshots (id, name, context, tenant, semester, username, data) '
+                                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                (meta.id, meta.name, json.dumps(context, sort_keys=True), context.get('tenant'),
+                                 context.get('semester'), context.get('username'),
+                                 zlib.compress(json.dumps(data, separators=(',', ':')).encode('utf-8'))))
+
+    def missing(self, scopes, seen):
+        """Returns (id, name, context) of the stored downloads within scopes that are not in seen."""
+        return [(id_, name, json.loads(context)) for (id_, name, context, tenant, semester, username)
+                in self.connection.execute('SELECT id, name, context, tenant, semester, username FROM snapshots')
+                if id_ not in seen and (tenant, semester, username) in scopes]
+
+    def delete(self, ids):
+        self.connection.executemany('DELETE FROM snapshots WHERE id = ?', [(id_,) for id_ in ids])
+
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Asyncio client for on demand lookups without a Scrapy crawl.
+
+Usage:
+async with StplClient('[tenant]', '[username]', '[password]') as client:
+    semesters = await client.get_semesters()
+    calendar = await client.get_class_calendar('[semester]', '[class]')
+
+Requests are built and parsed by StplSpider, so each lookup returns the Download the crawl would export for the same
+endpoint. Connections are pooled, the session is logged in once and renewed when the site invalidates it. Lookups may
+run concurrently, all of them share the session.
+
+Requires aiohttp (pip install mystundenplan-crawler[client]).
+"""
+import asyncio
+from scrapy.http import Headers
+from scrapy.responsetypes import responsetypes
+import mystundenplan.extract as extract
+from mystundenplan.items import Download
+from mystundenplan.spiders.schedule import StplSpider
+from mystundenplan.spiders.session import session_expired
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+class LoginError(Exception):
+    pass
+
+
+class StplClient(object):
+    """
+    Lookups of a single account. limit is the size of the connection pool, a lookup answered by the login page is
+    retried with a new session up to max_renewals times.
+    """
+
+    def __init__(self, tenant, username, password, login_url=None, limit=10, timeout=30, max_renewals=3):
+        if aiohttp is None:
+            raise ImportError('StplClient requires aiohttp (pip install mystundenplan-crawler[client])')
+        self.spider = StplSpider(tenant, username, password)
+        if login_url:
+            self.spider.login_url = login_url
+        self.account = next(iter(self.spider.credentials))
+        self.limit = limit
+        self.timeout = timeout
+        self.max_renewals = max_renewals
+        self.http = None
+        self.login_lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        if self.http is not None:
+            await self.http.close()
+            self.http = None
+
+    # --- LOOKUPS
+
+    async def get_semesters(self):
+        return await self.download(lambda a: self.spider.semester_json_request(a, None), self.spider.scrape_json)
+
+    async def get_index(self, semester):
+        """indexHtml of semester, its rooms are in data['cbraum']."""
+        return await self.download(lambda a: self.spider.index_html_request(a, semester, None), self.index_html)
+
+    async def get_course(self, semester, course):
+        """courseJson of course, listing its classes."""
+        return await self.download(lambda a: self.spider.course_json_request(a, semester, course, None),
+                                   self.spider.scrape_json)
+
+    async def get_class_calendar(self, semester, class_, course=None):
+        """classCalendarJson of class_, course only completes the context of the returned Meta."""
+        return await self.download(
+            lambda a: self.spider.class_calendar_json_request(a, semester, course, class_, None),
+            self.spider.scrape_json)
+
+    async def get_room_calendar(self, semester, room):
+        return await self.download(lambda a: self.spider.location_calendar_json_request(a, semester, room, None),
+                                   self.spider.scrape_json)
+
+    async def get_personal_calendar(self, semester):
+        return await self.download(lambda a: self.spider.personal_calendar_json_request(a, semester, None),
+                                   self.spider.scrape_json)
+
+    # --- HELPERS
+
+    def index_html(self, response):
+        data, _ = extract.index_html(response.text)
+        return [Download(meta=self.spider.extract_meta(response), data=data)]
+
+    async def download(self, build, parse):
+        """
+        Sends the request build(account) returns and parses the response with the spider callback parse. The request
+        is built again with a new session if the site invalidated the current one.
+        """
+        if self.account not in self.spider.sessions:
+            await self.login(None)
+
+        for _ in range(self.max_renewals + 1):
+            session = self.spider.sessions[self.account]
+            response = await self.fetch(build(self.account))
+            if not session_expired(response):
+                return next(iter(parse(response)))
+            await self.login(session)
+        raise LoginError('Session of %s expired again' % self.account)
+
+    async def login(self, stale):
+        """Logs in unless another lookup replaced the stale session (None while there is none) meanwhile."""
+        async with self.login_lock:
+            if self.spider.sessions.get(self.account) != stale:
+                return
+            response = await self.fetch(self.spider.login_request(self.account))
+            session = self.spider.session_from_response(response)
+            if session is None:
+                raise LoginError('Login of %s failed' % self.account)
+            self.spider.sessions[self.account] = session
+
+    async def fetch(self, request):
+        if self.http is None:
+            self.http = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.limit),
+                                              cookie_jar=aiohttp.CookieJar(unsafe=True),
+                                              timeout=aiohttp.ClientTimeout(total=self.timeout))
+        async with self.http.request(request.method, request.url, data=request.body,
+                                     headers=request.headers.to_unicode_dict()) as r:
+            r.raise_for_status()
+            body = await r.read()
+            # aiohttp already decoded the body
+            headers = Headers([(k, v) for (k, v) in r.headers.items() if k.lower() != 'content-encoding'])
+        url = str(r.url)
+        cls = responsetypes.from_args(headers=headers, url=url, body=body)
+        return cls(url=url, status=r.status, headers=headers, body=body, request=request)
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+import hashlib
+from collections import namedtuple
+from datetime import datetime
+from mystundenplan.spiders.schedule import Key
+
+# calendar endpoints and the context key of the entity each view belongs to
+CALENDAR_VIEWS = {
+    'classCalendarJson': Key.CLASS,
+    'locationCalendarJson': Key.LOCATION,
+    'personalCalendarJson': 'username',
+}
+
+# field positions of the wdCalendar list format returned by mode=calendar&method=list
+WD_ID, WD_TITLE, WD_START, WD_END, WD_LOCATION = 0, 1, 2, 3, 9
+WD_TIME_FORMAT = '%m/%d/%Y %H:%M'
+
+TIME_FORMAT = '%Y-%m-%d %H:%M'
+
+# key of the event references replacing the events of an interned calendar payload
+INTERNED = 'event_keys'
+
+Event = namedtuple('Event', ['key', 'id', 'title', 'starts', 'ends', 'location', 'data'])
+
+
+def normalize_time(value):
+    if not value:
+        return None
+    for time_format in (WD_TIME_FORMAT, TIME_FORMAT, '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.strptime(value, time_format).strftime(TIME_FORMAT)
+        except ValueError:
+            pass
+    return value
+
+
+def event_key(tenant, semester, title, starts, ends, location):
+    """Identity of an event, independent of the view (class, room or personal calendar) it was found in."""
+    fp = hashlib.sha1('\x1f'.join(str(v) for v in (tenant, semester, title, starts, ends, location)).encode('utf-8'))
+    return fp.hexdigest()[:20]
+
+
+def parse_event(entry, tenant, semester):
+    """Returns the Event of a calendar entry or None if the entry is not an event."""
+    if isinstance(entry, dict):
+        id_ = entry.get('id')
+        title = entry.get('title')
+        starts = entry.get('start')
+        ends = entry.get('end')
+        location = entry.get('location')
+    elif isinstance(entry, list) and len(entry) > WD_END:
+        id_ = entry[WD_ID]
+        title = entry[WD_TITLE]
+        starts = entry[WD_START]
+        ends = entry[WD_END]
+        location = entry[WD_LOCATION] if len(entry) > WD_LOCATION else None
+    else:
+        return None
+
+    starts = normalize_time(starts)
+    ends = normalize_time(ends)
+    return Event(event_key(tenant, semester, title, starts, ends, location), id_, title, starts, ends, location, entry)
+
+
+def parse_events(data, tenant, semester):
+    """Yields an Event for each entry of a calendar payload."""
+    entries = data.get('events') if isinstance(data, dict) else data
+    for entry in entries or []:
+        event = parse_event(entry, tenant, semester)
+        if event is not None:
+            yield event
+
+
+def intern_events(data, tenant, semester, seen):
+    """
+    Splits a calendar payload into the events not contained in seen and the payload with its events replaced by
+    references. seen is updated with all event keys of the payload.
+    """
+    events = []
+    keys = []
+    for event in parse_events(data, tenant, semester):
+        keys.append(event.key)
+        if event.key not in seen:
+            seen.add(event.key)
+            events.append(event)
+
+    interned = {k: v for (k, v) in data.items() if k != 'events'} if isinstance(data, dict) else {}
+    interned[INTERNED] = keys
+    return events, interned
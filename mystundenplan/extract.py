@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Extraction of the HTML pages (indexHtml and the cbGrid calendar pages).
+
+Each page is parsed once. The JS variables of the index page are read in a single scan of its last script, cbGrid
+pages are only parsed up to the calendar grid, which is the bulk of the page and never used.
+"""
+import re
+from parsel import Selector
+
+# JS variables of the index page and the data keys they are stored under
+SCRIPT_VARIABLES = {
+    'indexLink': 'indexLink',
+    'frontendDir': 'frontendDir',
+    'STPL.IndexLink': 'stplIndexLink',
+    'Vorlesungsanfang': 'vorlesungsanfang',
+    'Vorlesungsende': 'vorlesungsende',
+    'Semesteranfang': 'semesteranfang',
+    'Semesterende': 'semesterende',
+}
+
+SCRIPT_VARIABLE_PATTERN = re.compile(r"(%s) = '(.*)';" % '|'.join(re.escape(v) for v in SCRIPT_VARIABLES))
+STUNDENRASTER_PATTERN = re.compile(r"stundenraster\[\d+\] = \['(\d{2}.\d{2})', '(\d{2}.\d{2})', '(\d+)'\];")
+DESCRIPTION_PATTERN = re.compile(r'Beschreibung: (.*)$')
+TYPE_PATTERN = re.compile(r'Raumtyp: (.*)$')
+
+# the grid follows the page title and subtitle
+GRID_HEADER_END = re.compile(r'id=["\']content_subtitle["\'].*?(?=<table)', re.DOTALL)
+
+
+def script_variables(script):
+    """Returns the JS variables of script, the first assignment of each variable wins."""
+    data = dict.fromkeys(SCRIPT_VARIABLES.values())
+    for m in SCRIPT_VARIABLE_PATTERN.finditer(script):
+        key = SCRIPT_VARIABLES[m.group(1)]
+        if data[key] is None:
+            data[key] = m.group(2)
+    data['stundenraster'] = [{'slot': slot, 'starts': starts, 'ends': ends}
+                             for (starts, ends, slot) in STUNDENRASTER_PATTERN.findall(script)]
+    return data
+
+
+def options(root, id_):
+    """Returns the options of select #id_ without the first (-1) placeholder as lxml elements."""
+    return root.xpath('//*[@id=$id]/option[preceding-sibling::*]', id=id_)
+
+
+def index_html(text):
+    """Returns the data of an indexHtml page and its course ids."""
+    html = Selector(text=text)
+    root = html.root
+    courses = [option.get('value') for option in options(root, 'cbstg')]
+
+    scripts = root.xpath('//head/*[last()][self::script]')
+    data = {'title': html.css('head > title::text').get()}
+    data.update(script_variables(''.join(scripts[0].itertext()) if scripts else ''))
+    data['cbraum'] = [{'id': option.get('value'), 'title': option.get('title'), 'name': option.text}
+                      for option in options(root, 'cbraum')]
+    return data, courses
+
+
+def grid_header(text):
+    """Returns a Selector of a cbGrid page without its calendar grid."""
+    m = GRID_HEADER_END.search(text)
+    return Selector(text=text[:m.end()] if m else text)
+
+
+def personal_calendar_html(text):
+    html = grid_header(text)
+    return {'title': html.css('#content_title > h2::text').get()}
+
+
+def class_calendar_html(text):
+    html = grid_header(text)
+    return {
+        'title': html.css('#content_title > h2::text').get(),
+        'subtitle': html.css('#content_subtitle > div::text').get(),
+    }
+
+
+def location_calendar_html(text):
+    html = grid_header(text)
+    return {
+        'title': html.css('#content_title > h2::text').get(),
+        'subtitle': html.css('#content_subtitle > div > div:nth-child(1)::text').get(),
+        'description': html.css('#content_subtitle > div > div:nth-child(2)::text').re_first(DESCRIPTION_PATTERN),
+        'type': html.css('#content_subtitle > div > div:nth-child(3)::text').re_first(TYPE_PATTERN),
+    }
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import pickle
+import sqlite3
+import zlib
+from weakref import WeakKeyDictionary
+from scrapy.utils.request import request_from_dict
+from mystundenplan.httpcache import session_fingerprint
+from mystundenplan.spiders.session import without_session
+
+
+def dump_request(request, spider):
+    """Serializes request without its session fields."""
+    return zlib.compress(pickle.dumps(without_session(request).to_dict(spider=spider), pickle.HIGHEST_PROTOCOL))
+
+
+def load_request(data, spider):
+    return request_from_dict(pickle.loads(zlib.decompress(data)), spider=spider)
+
+
+class SessionRequestFingerprinter(object):
+    """
+    Request fingerprinter ignoring the session fields, so a request keeps its fingerprint after a fresh login. The
+    account is part of the fingerprint, different accounts still fetch the same endpoint on their own.
+    """
+
+    def __init__(self):
+        self.cache = WeakKeyDictionary()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls()
+
+    def fingerprint(self, request):
+        if request not in self.cache:
+            fp = hashlib.sha1(session_fingerprint(request).encode('ascii'))
+            fp.update(str(request.meta.get('account')).encode('utf-8'))
+            self.cache[request] = fp.digest()
+        return self.cache[request]
+
+
+class FrontierStore(object):
+    """
+    SQLite record of a crawl: the requests scheduled but not yet processed (stored without session fields), the
+    Meta.ids of the processed ones and the (tenant, semester) pairs semesterJson marked as current.
+
+    A response is marked completed together with the requests it produced in one transaction, so a crash never loses
+    a branch of the traversal.
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS pending (id TEXT PRIMARY KEY, account TEXT, request BLOB)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS completed (id TEXT PRIMARY KEY)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS current_semesters ('
+                                'tenant TEXT, semester TEXT, PRIMARY KEY (tenant, semester))')
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def completed(self):
+        return set(row[0] for row in self.connection.execute('SELECT id FROM completed'))
+
+    def current_semesters(self):
+        return set(self.connection.execute('SELECT tenant, semester FROM current_semesters'))
+
+    def add_current_semesters(self, semesters):
+        with self.connection:
+            self.connection.executemany('INSERT OR IGNORE INTO current_semesters (tenant, semester) VALUES (?, ?)',
+                                        semesters)
+
+    def pending(self, account, spider):
+        """Returns the stored requests of account, still without session fields."""
+        return [load_request(row[0], spider)
+                for row in self.connection.execute('SELECT request FROM pending WHERE account = ?', (account,))]
+
+    def complete(self, id_, requests, spider):
+        """Marks id_ (None for the login) as completed and stores the requests its response produced."""
+        with self.connection:
+            self.connection.executemany(
+                'INSERT INTO pending (id, account, request) VALUES (?, ?, ?) ON CONFLICT(id) DO NOTHING',
+                [(request.meta['meta'].id, request.meta['account'], dump_request(request, spider))
+                 for request in requests])
+            if id_ is not None:
+                self.connection.execute('DELETE FROM pending WHERE id = ?', (id_,))
+                self.connection.execute('INSERT INTO completed (id) VALUES (?) ON CONFLICT(id) DO NOTHING', (id_,))
+
+    def clear(self):
+        with self.connection:
+            self.connection.execute('DELETE FROM pending')
+            self.connection.execute('DELETE FROM completed')
+            self.connection.execute('DELETE FROM current_semesters')
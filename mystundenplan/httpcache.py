@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import logging
+import sqlite3
+import zlib
+from pathlib import Path
+from time import time
+from urllib.parse import parse_qsl, urlencode, urlparse, urlunparse
+from scrapy.http import Headers
+from scrapy.responsetypes import responsetypes
+from scrapy.utils.project import data_path
+from w3lib.url import canonicalize_url
+from mystundenplan.spiders.session import session_expired
+
+logger = logging.getLogger(__name__)
+
+# request fields that change with every login and must not take part in the fingerprint (cache_fingerprint adds the
+# user back where responses differ per account)
+VOLATILE_FIELDS = {'User', 'Session', 'pwd'}
+
+COMMIT_INTERVAL = 100
+
+
+def strip_volatile(pairs):
+    return sorted((k, v) for (k, v) in pairs if k not in VOLATILE_FIELDS)
+
+
+def session_fingerprint(request):
+    url = urlparse(request.url)
+    url = url._replace(query=urlencode(strip_volatile(parse_qsl(url.query, keep_blank_values=True))))
+    form = strip_volatile(parse_qsl(request.body.decode('utf-8'), keep_blank_values=True)) if request.body else []
+
+    fp = hashlib.sha1()
+    fp.update(request.method.encode('ascii'))
+    fp.update(canonicalize_url(urlunparse(url)).encode('utf-8'))
+    fp.update(urlencode(form).encode('utf-8'))
+    return fp.hexdigest()
+
+
+def cache_fingerprint(request):
+    """
+    session_fingerprint plus the username of per account endpoints (their Meta shows it) or the account of requests
+    without Meta (the login and its redirect), so accounts of one tenant never share these responses. Tenant wide
+    endpoints are cached once, whichever account fetched them.
+    """
+    meta = request.meta.get('meta')
+    owner = meta.context.get('username') if meta is not None else request.meta.get('account')
+    if owner is None:
+        return session_fingerprint(request)
+    fp = hashlib.sha1(session_fingerprint(request).encode('ascii'))
+    fp.update(owner.encode('utf-8'))
+    return fp.hexdigest()
+
+
+class SqliteCacheStorage(object):
+    """
+    HTTP cache storage keeping all responses of a spider in one SQLite file.
+
+    Requests are fingerprinted without the session fields (see cache_fingerprint), so responses stay valid across
+    logins. Together with
+    HTTPCACHE_IGNORE_MISSING this replays a full crawl without any network access.
+    """
+
+    def __init__(self, settings):
+        self.cachedir = data_path(settings['HTTPCACHE_DIR'], createdir=True)
+        self.expiration_secs = settings.getint('HTTPCACHE_EXPIRATION_SECS')
+        self.connection = None
+        self.pending = 0
+
+    def open_spider(self, spider):
+        dbpath = Path(self.cachedir, '%s.sqlite' % spider.name)
+        self.connection = sqlite3.connect(str(dbpath))
+        self.connection.execute('CREATE TABLE IF NOT EXISTS responses ('
+                                'fingerprint TEXT PRIMARY KEY, time REAL, status INTEGER, url TEXT, headers TEXT, '
+                                'body BLOB)')
+        logger.debug('Using SQLite cache storage in %(cachepath)s', {'cachepath': dbpath}, extra={'spider': spider})
+
+    def close_spider(self, spider):
+        self.connection.commit()
+        self.connection.close()
+
+    def retrieve_response(self, spider, request):
+        row = self.connection.execute('SELECT time, status, url, headers, body FROM responses WHERE fingerprint = ?',
+                                      (cache_fingerprint(request),)).fetchone()
+        if row is None:
+            return None  # not cached
+
+        ts, status, url, headers, body = row
+        if 0 < self.expiration_secs < time() - ts:
+            return None  # expired
+
+        request.meta['cache_timestamp'] = ts
+        headers = Headers(json.loads(headers))
+        body = zlib.decompress(body)
+        respcls = responsetypes.from_args(headers=headers, url=url, body=body)
+        return respcls(url=url, headers=headers, status=status, body=body, request=request)
+
+    def store_response(self, spider, request, response):
+        if session_expired(response):
+            return  # the login page of an expired session, replays would get it for every request
+        headers = {k.decode('latin-1'): [v.decode('latin-1') for v in vs] for (k, vs) in response.headers.items()}
+        self.connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                                (cache_fingerprint(request), time(), response.status, response.url,
+                                 json.dumps(headers), zlib.compress(response.body)))
+        self.pending += 1
+        if self.pending >= COMMIT_INTERVAL:
+            self.connection.commit()
+            self.pending = 0
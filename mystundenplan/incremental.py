@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import sqlite3
+import time
+import zlib
+
+
+def content_hash(data):
+    return hashlib.sha1(json.dumps(data, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+
+class IncrementalStore(object):
+    """
+    Local store keyed by Meta.id holding the content hash of the last emitted payload and the last fetched response.
+
+    Connections run in autocommit mode on a WAL journal so the downloader middleware and the item pipeline can share
+    one file without holding long write locks.
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS downloads ('
+                                'id TEXT PRIMARY KEY, hash TEXT, fetched REAL, url TEXT, encoding TEXT, body BLOB)')
+
+    def close(self):
+        self.connection.close()
+
+    def response(self, id_, max_age):
+        """Returns (url, encoding, body) of the stored response if it was fetched within max_age seconds."""
+        row = self.connection.execute('SELECT url, encoding, body FROM downloads WHERE id = ? AND fetched >= ?',
+                                      (id_, time.time() - max_age)).fetchone()
+        if row is None or row[2] is None:
+            return None
+        return row[0], row[1], zlib.decompress(row[2])
+
+    def put_response(self, id_, url, encoding, body):
+        self.connection.execute('INSERT INTO downloads (id, fetched, url, encoding, body) VALUES (?, ?, ?, ?, ?) '
+                                'ON CONFLICT(id) DO UPDATE SET '
+                                'fetched = excluded.fetched, url = excluded.url, encoding = excluded.encoding, '
+                                'body = excluded.body',
+                                (id_, time.time(), url, encoding, zlib.compress(body)))
+
+    def update_hash(self, id_, digest):
+        """Stores digest for id_ and returns False if it equals the stored one."""
+        row = self.connection.execute('SELECT hash FROM downloads WHERE id = ?', (id_,)).fetchone()
+        if row is not None and row[0] == digest:
+            return False
+        self.connection.execute('INSERT INTO downloads (id, hash) VALUES (?, ?) '
+                                'ON CONFLICT(id) DO UPDATE SET hash = excluded.hash', (id_, digest))
+        return True
@@ -2,6 +2,24 @@
 import scrapy
 
 
+def serialize_meta(meta):
+    return {'id': meta.id, 'name': meta.name, 'context': meta.context}
+
+
 class Download(scrapy.Item):
-    meta = scrapy.Field()
-    data = scrapy.Field()
\ No newline at end of file
+    # the Meta of the response, exported as {id, name, context}
+    meta = scrapy.Field(serializer=serialize_meta)
+    data = scrapy.Field()
+
+
+class Reference(scrapy.Item):
+    # the Meta of a download skipped as duplicate and the Meta.id of the download holding its data
+    meta = scrapy.Field(serializer=serialize_meta)
+    ref = scrapy.Field()
+
+
+class CalendarEvent(scrapy.Item):
+    key = scrapy.Field()
+    tenant = scrapy.Field()
+    semester = scrapy.Field()
+    data = scrapy.Field()
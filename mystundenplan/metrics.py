@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Per endpoint crawl metrics kept in the stats collector.
+
+Histograms are stored as one stats value per bucket, metrics/[name]/[metric]/bucket/[le], plus .../sum and .../count.
+Counters are stored as metrics/[name]/[counter]/[label]. Endpoints are named by Meta.name, requests without Meta
+(the login) as 'login'.
+"""
+import json
+import os
+import time
+from bisect import bisect_left
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from twisted.internet import task
+
+INF = float('inf')
+
+# metric: (prometheus name, bucket upper bounds)
+HISTOGRAMS = {
+    'latency': ('download_latency_seconds', [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, INF]),
+    'size': ('response_size_bytes', [1024, 4096, 16384, 65536, 262144, 1048576, 4194304, INF]),
+    'parse': ('parse_seconds', [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, INF]),
+    'fanout': ('fanout_requests', [0, 1, 5, 10, 50, 100, 500, 1000, INF]),
+}
+
+# counter: (prometheus name, label)
+COUNTERS = {
+    'errors': ('errors_total', 'error'),
+    'requests': ('requests_total', 'child'),
+    'items': ('items_total', 'item'),
+}
+
+PREFIX = 'metrics/'
+NAMESPACE = 'mystundenplan'
+
+
+def endpoint(request):
+    meta = request.meta.get('meta')
+    return meta.name if meta is not None else 'login'
+
+
+def bound(le):
+    if le == INF:
+        return 'inf'
+    return '%d' % le if le == int(le) else repr(le)
+
+
+def observe(stats, name, metric, value):
+    buckets = HISTOGRAMS[metric][1]
+    le = buckets[bisect_left(buckets, value)]
+    stats.inc_value('%s%s/%s/bucket/%s' % (PREFIX, name, metric, bound(le)))
+    stats.inc_value('%s%s/%s/sum' % (PREFIX, name, metric), value)
+    stats.inc_value('%s%s/%s/count' % (PREFIX, name, metric))
+
+
+def count(stats, name, counter, label, value=1):
+    stats.inc_value('%s%s/%s/%s' % (PREFIX, name, counter, label), value)
+
+
+def collect(stats):
+    """Returns {name: {metric: {...}}} of the metrics in the stats dict."""
+    endpoints = {}
+    for (key, value) in stats.items():
+        if not key.startswith(PREFIX):
+            continue
+        name, metric, rest = key[len(PREFIX):].split('/', 2)
+        entry = endpoints.setdefault(name, {}).setdefault(metric, {})
+        if metric in HISTOGRAMS and rest.startswith('bucket/'):
+            entry.setdefault('buckets', {})[rest[len('bucket/'):]] = value
+        else:
+            entry[rest] = value
+    return endpoints
+
+
+def cumulative(histogram, buckets):
+    """Returns the (le, cumulative count) pairs of a histogram."""
+    total = 0
+    result = []
+    for le in buckets:
+        total += histogram.get('buckets', {}).get(bound(le), 0)
+        result.append((le, total))
+    return result
+
+
+def quantile(pairs, q):
+    """Upper bound of the bucket holding quantile q."""
+    if not pairs or not pairs[-1][1]:
+        return None
+    for (le, total) in pairs:
+        if total >= q * pairs[-1][1]:
+            return le
+
+
+def snapshot(stats):
+    endpoints = collect(stats)
+    for metrics in endpoints.values():
+        for (metric, histogram) in metrics.items():
+            if metric not in HISTOGRAMS:
+                continue
+            pairs = cumulative(histogram, HISTOGRAMS[metric][1])
+            histogram['buckets'] = {bound(le): total for (le, total) in pairs}
+            histogram['mean'] = histogram['sum'] / histogram['count'] if histogram.get('count') else None
+            histogram['p50'] = quantile(pairs, 0.5)
+            histogram['p95'] = quantile(pairs, 0.95)
+    return {'time': time.time(), 'endpoints': endpoints}
+
+
+def label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus(stats):
+    """Renders the metrics in the Prometheus text exposition format."""
+    endpoints = collect(stats)
+    lines = []
+    for (metric, (metric_name, buckets)) in HISTOGRAMS.items():
+        metric_name = '%s_%s' % (NAMESPACE, metric_name)
+        lines.append('# TYPE %s histogram' % metric_name)
+        for (name, metrics) in sorted(endpoints.items()):
+            if metric not in metrics:
+                continue
+            histogram = metrics[metric]
+            for (le, total) in cumulative(histogram, buckets):
+                lines.append('%s_bucket{endpoint="%s",le="%s"} %d'
+                             % (metric_name, label(name), '+Inf' if le == INF else bound(le), total))
+            lines.append('%s_sum{endpoint="%s"} %r' % (metric_name, label(name), float(histogram.get('sum', 0))))
+            lines.append('%s_count{endpoint="%s"} %d' % (metric_name, label(name), histogram.get('count', 0)))
+    for (counter, (counter_name, label_name)) in COUNTERS.items():
+        counter_name = '%s_%s' % (NAMESPACE, counter_name)
+        lines.append('# TYPE %s counter' % counter_name)
+        for (name, metrics) in sorted(endpoints.items()):
+            for (value, total) in sorted(metrics.get(counter, {}).items()):
+                lines.append('%s{endpoint="%s",%s="%s"} %d' % (counter_name, label(name), label_name, label(value),
+                                                                total))
+    return '\n'.join(lines) + '\n'
+
+
+def write_atomic(path, text):
+    tmp = '%s.tmp' % path
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+class MetricsExtension(object):
+    """
+    Writes snapshots of the metrics every METRICS_INTERVAL seconds and when the spider closes, as JSON to
+    METRICS_JSON_PATH and in the Prometheus text format to METRICS_PROMETHEUS_PATH (for the node exporter's textfile
+    collector).
+    """
+
+    def __init__(self, crawler, interval, json_path, prometheus_path):
+        self.crawler = crawler
+        self.interval = interval
+        self.json_path = json_path
+        self.prometheus_path = prometheus_path
+        self.task = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('METRICS_ENABLED'):
+            raise NotConfigured
+        if not (settings.get('METRICS_JSON_PATH') or settings.get('METRICS_PROMETHEUS_PATH')):
+            raise NotConfigured
+        s = cls(crawler, settings.getfloat('METRICS_INTERVAL'), settings.get('METRICS_JSON_PATH'),
+                settings.get('METRICS_PROMETHEUS_PATH'))
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    def spider_opened(self, spider):
+        if self.interval > 0:
+            self.task = task.LoopingCall(self.export)
+            self.task.start(self.interval, now=False)
+
+    def spider_closed(self, spider):
+        if self.task is not None and self.task.running:
+            self.task.stop()
+        self.export()
+
+    def export(self):
+        stats = self.crawler.stats.get_stats()
+        if self.json_path:
+            write_atomic(self.json_path, json.dumps(snapshot(stats), indent=2))
+        if self.prometheus_path:
+            write_atomic(self.prometheus_path, prometheus(stats))
@@ -5,7 +5,21 @@
 # See documentation in:
 # http://doc.scrapy.org/en/latest/topics/spider-middleware.html
 
+import time
+from twisted.internet.defer import Deferred
 from scrapy import signals
+from scrapy.exceptions import DontCloseSpider, IgnoreRequest, NotConfigured
+from scrapy.http import Request, TextResponse
+from scrapy.utils.defer import maybe_deferred_to_future
+from scrapy.utils.httpobj import urlparse_cached
+import mystundenplan.metrics as metrics
+from mystundenplan.events import CALENDAR_VIEWS, INTERNED, intern_events
+from mystundenplan.frontier import FrontierStore
+from mystundenplan.incremental import IncrementalStore
+from mystundenplan.items import CalendarEvent, Download, Reference
+from mystundenplan.spiders.schedule import entity_key, entity_meta
+from mystundenplan.spiders.session import form_field, session_expired, with_session
+from mystundenplan.workqueue import WorkQueue, worker_name
 
 
 class MystundenplanSpiderMiddleware(object):
@@ -54,3 +68,645 @@ class MystundenplanSpiderMiddleware(object):
 
     def spider_opened(self, spider):
         spider.logger.info('Spider opened: %s' % spider.name)
+
+
+class IncrementalMiddleware(object):
+    """
+    Serves responses from the incremental store while they are younger than the TTL configured for their endpoint.
+
+    TTLs are looked up by Meta.name in INCREMENTAL_TTL. Endpoints without an entry inherit the TTL of their parent in
+    the spider's traversal tree, so a single entry covers a whole subtree.
+    """
+
+    def __init__(self, crawler, store, ttl, default_ttl):
+        self.crawler = crawler
+        self.store = store
+        self.ttl = ttl
+        self.default_ttl = default_ttl
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('INCREMENTAL_ENABLED'):
+            raise NotConfigured
+        s = cls(crawler, IncrementalStore(crawler.settings.get('INCREMENTAL_PATH')),
+                crawler.settings.getdict('INCREMENTAL_TTL'), crawler.settings.getint('INCREMENTAL_TTL_DEFAULT'))
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    def process_request(self, request, spider=None):
+        meta = request.meta.get('meta')
+        if meta is None:
+            return None
+
+        ttl = self.subtree_ttl(meta.name)
+        if ttl <= 0:
+            return None
+
+        stored = self.store.response(entity_meta(meta).id, ttl)
+        if stored is None:
+            self.crawler.stats.inc_value('incremental/miss')
+            return None
+
+        self.crawler.stats.inc_value('incremental/fresh')
+        url, encoding, body = stored
+        return TextResponse(url, body=body, encoding=encoding, request=request, flags=['incremental'])
+
+    def process_response(self, request, response, spider=None):
+        meta = request.meta.get('meta')
+        if meta is None or 'incremental' in response.flags or response.status != 200 \
+                or not isinstance(response, TextResponse):
+            return response
+
+        if self.subtree_ttl(meta.name) > 0:
+            self.store.put_response(entity_meta(meta).id, response.url, response.encoding, response.body)
+        return response
+
+    def subtree_ttl(self, name):
+        tree = getattr(self.crawler.spider, 'tree', {})
+        while name is not None:
+            if name in self.ttl:
+                return int(self.ttl[name])
+            name = tree.get(name)
+        return self.default_ttl
+
+    def spider_closed(self, spider):
+        self.store.close()
+
+
+class EventInterningMiddleware(object):
+    """
+    Emits each calendar event once per crawl as CalendarEvent item and replaces the events of class, location and
+    personal calendar downloads with references to them.
+    """
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+        self.seen = set()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('EVENT_INTERNING_ENABLED'):
+            raise NotConfigured
+        return cls(crawler)
+
+    def process_spider_output(self, response, result, spider=None):
+        for i in result:
+            yield from self.intern(i)
+
+    async def process_spider_output_async(self, response, result, spider=None):
+        async for i in result:
+            for j in self.intern(i):
+                yield j
+
+    def intern(self, item):
+        if not isinstance(item, Download) or item['meta'].name not in CALENDAR_VIEWS:
+            return [item]
+
+        context = item['meta'].context
+        events, data = intern_events(item['data'], context.get('tenant'), context.get('semester'), self.seen)
+        self.crawler.stats.inc_value('interning/events', len(events))
+        self.crawler.stats.inc_value('interning/references', len(data[INTERNED]))
+
+        items = [CalendarEvent(key=e.key, tenant=context.get('tenant'), semester=context.get('semester'), data=e.data)
+                 for e in events]
+        items.append(Download(meta=item['meta'], data=data))
+        return items
+
+
+class DeduplicationMiddleware(object):
+    """
+    Sends a single request per entity (see entity_key), e.g. for a class listed by several courses. Requests and
+    derived downloads of an entity reached through another parent are replaced by a Reference item holding their Meta
+    and the Meta.id of the download fetched for the entity.
+    """
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+        self.fetched = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('DEDUPLICATION_ENABLED'):
+            raise NotConfigured
+        return cls(crawler)
+
+    def process_spider_output(self, response, result, spider=None):
+        for i in result:
+            yield self.deduplicate(i)
+
+    async def process_spider_output_async(self, response, result, spider=None):
+        async for i in result:
+            yield self.deduplicate(i)
+
+    def deduplicate(self, item):
+        if isinstance(item, Request):
+            meta = item.meta.get('meta')
+        elif isinstance(item, Download):
+            meta = item['meta']
+        else:
+            return item
+
+        key = entity_key(meta) if meta is not None else None
+        if key is None:
+            return item
+        ref = self.fetched.setdefault(key, meta.id)
+        if ref == meta.id:
+            return item
+        self.crawler.stats.inc_value('dedup/%s' % meta.name)
+        return Reference(meta=meta, ref=ref)
+
+
+class FrontierMiddleware(object):
+    """
+    Records the frontier of the crawl in the FrontierStore at FRONTIER_PATH, so an interrupted crawl resumes where it
+    stopped: requests of completed Meta.ids are dropped and the pending requests of an account are scheduled again,
+    with its new session, once it is logged in. The current semesters are restored as well, since the completed
+    semesterJson is not fetched again and requests built after the resume still get their priority.
+
+    The store is cleared when a crawl finishes.
+    """
+
+    def __init__(self, crawler, store):
+        self.crawler = crawler
+        self.store = store
+        self.completed = store.completed()
+        self.resumed = set()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        path = crawler.settings.get('FRONTIER_PATH')
+        if not path:
+            raise NotConfigured
+        s = cls(crawler, FrontierStore(path))
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    def process_spider_output(self, response, result, spider=None):
+        requests = []
+        for i in result:
+            if self.keep(i, requests):
+                yield i
+        yield from self.complete(response, requests)
+
+    async def process_spider_output_async(self, response, result, spider=None):
+        requests = []
+        async for i in result:
+            if self.keep(i, requests):
+                yield i
+        for i in self.complete(response, requests):
+            yield i
+
+    def keep(self, item, requests):
+        if not isinstance(item, Request) or 'meta' not in item.meta:
+            return True
+        if item.meta['meta'].id in self.completed:
+            self.crawler.stats.inc_value('frontier/skipped')
+            return False
+        requests.append(item)
+        return True
+
+    def complete(self, response, requests):
+        meta = response.meta.get('meta')
+        spider = self.crawler.spider
+        if meta is not None and meta.name == 'semesterJson':
+            # stored before semesterJson is completed, a resume either refetches it or finds them
+            self.store.add_current_semesters(spider.current_semesters)
+        self.store.complete(meta.id if meta is not None else None, requests, spider)
+
+        # the login response of an account, resume its pending requests
+        account = response.meta.get('account')
+        if meta is not None or account is None or account in self.resumed or account not in spider.sessions:
+            return []
+        self.resumed.add(account)
+        restored = [with_session(request, spider.sessions[account]) for request in self.store.pending(account, spider)
+                    if request.meta['meta'].id not in self.completed]
+        if restored:
+            self.crawler.stats.inc_value('frontier/restored', len(restored))
+            spider.logger.info('Resuming %s pending request(s) of %s' % (len(restored), account))
+        return restored
+
+    def spider_opened(self, spider):
+        spider.current_semesters.update(self.store.current_semesters())
+
+    def spider_closed(self, spider, reason):
+        if reason == 'finished':
+            self.store.clear()
+        self.store.close()
+
+
+class WorkQueueMiddleware(object):
+    """
+    Distributes a crawl over processes sharing the WorkQueue at WORKQUEUE_PATH.
+
+    The coordinator (WORKQUEUE_ROLE = 'coordinator') crawls as usual, but pushes the requests of WORKQUEUE_ENDPOINTS to
+    the queue instead of scheduling them. Workers (WORKQUEUE_ROLE = 'worker') only log in and lease batches of queued
+    requests whenever they run idle, sending them with the session of their own account of the same tenant. Failed
+    requests go back to the queue. Workers stop once the coordinator finished and all requests are done.
+    """
+
+    def __init__(self, crawler, queue, role, endpoints, batch_size, worker):
+        self.crawler = crawler
+        self.queue = queue
+        self.role = role
+        self.endpoints = endpoints
+        self.batch_size = batch_size
+        self.worker = worker
+        self.leased = set()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.get('WORKQUEUE_PATH'):
+            raise NotConfigured
+        role = settings.get('WORKQUEUE_ROLE')
+        if role not in ('coordinator', 'worker'):
+            raise NotConfigured('Unknown WORKQUEUE_ROLE %s' % role)
+
+        queue = WorkQueue(settings.get('WORKQUEUE_PATH'), settings.getint('WORKQUEUE_LEASE'),
+                          settings.getint('WORKQUEUE_MAX_ATTEMPTS'))
+        s = cls(crawler, queue, role, set(settings.getlist('WORKQUEUE_ENDPOINTS')),
+                settings.getint('WORKQUEUE_BATCH_SIZE'), worker_name(settings))
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        if role == 'worker':
+            crawler.signals.connect(s.spider_idle, signal=signals.spider_idle)
+        return s
+
+    def process_spider_output(self, response, result, spider=None):
+        pushed = []
+        for i in result:
+            if self.keep(response, i, pushed):
+                yield i
+        self.complete(response, pushed)
+
+    async def process_spider_output_async(self, response, result, spider=None):
+        pushed = []
+        async for i in result:
+            if self.keep(response, i, pushed):
+                yield i
+        self.complete(response, pushed)
+
+    def keep(self, response, item, pushed):
+        if not isinstance(item, Request) or 'meta' not in item.meta:
+            return True
+        if self.role == 'worker':
+            # discovery is left to the coordinator
+            return 'meta' in response.meta
+        if item.meta['meta'].name in self.endpoints:
+            pushed.append(item)
+            return False
+        return True
+
+    def complete(self, response, pushed):
+        if pushed:
+            credentials = self.crawler.spider.credentials
+            self.queue.push(pushed, [credentials[r.meta['account']].tenant for r in pushed], self.crawler.spider)
+            self.crawler.stats.inc_value('workqueue/pushed', len(pushed))
+
+        meta = response.meta.get('meta')
+        if meta is not None and meta.id in self.leased:
+            self.leased.discard(meta.id)
+            self.queue.done(meta.id)
+            self.crawler.stats.inc_value('workqueue/done')
+
+    def spider_idle(self, spider):
+        # the first logged in account of each tenant sends the requests of that tenant
+        accounts = {}
+        for account in spider.sessions:
+            accounts.setdefault(spider.credentials[account].tenant, account)
+        if not accounts:
+            return
+
+        requests = self.queue.lease_requests(self.worker, list(accounts), self.batch_size, spider)
+        for request in requests:
+            account = accounts[request.meta['meta'].context['tenant']]
+            request.meta['account'] = account
+            self.leased.add(request.meta['meta'].id)
+            request = with_session(request, spider.sessions[account])
+            self.crawler.engine.crawl(request.replace(dont_filter=True, errback=self.failed))
+        if requests:
+            self.crawler.stats.inc_value('workqueue/leased', len(requests))
+            raise DontCloseSpider
+
+        self.queue.fail_expired()
+        if not self.queue.discovery_finished() or self.queue.outstanding():
+            raise DontCloseSpider
+
+    def failed(self, failure):
+        meta = failure.request.meta['meta']
+        self.crawler.spider.logger.warning('Returning %s to the queue: %s' % (meta.id, failure.value))
+        self.leased.discard(meta.id)
+        self.queue.release(meta.id)
+        self.crawler.stats.inc_value('workqueue/failed')
+
+    def spider_opened(self, spider):
+        if self.role == 'coordinator':
+            self.queue.start_discovery()
+
+    def spider_closed(self, spider, reason):
+        if self.role == 'coordinator':
+            # also if the crawl was cut short, workers stop after the requests pushed so far instead of waiting forever
+            if reason != 'finished':
+                spider.logger.warning('Discovery ended early (%s), the queue only holds the requests pushed so far'
+                                      % reason)
+            self.queue.finish_discovery()
+        self.queue.close()
+
+
+class MetricsSpiderMiddleware(object):
+    """Records parse time, fan-out (requests and items produced per response) and callback errors per endpoint."""
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('METRICS_ENABLED'):
+            raise NotConfigured
+        return cls(crawler)
+
+    def process_spider_output(self, response, result, spider=None):
+        counts = {}
+        elapsed = 0.0
+        result = iter(result)
+        while True:
+            started = time.perf_counter()
+            try:
+                i = next(result)
+            except StopIteration:
+                break
+            finally:
+                elapsed += time.perf_counter() - started
+            self.tally(i, counts)
+            yield i
+        self.record(response, elapsed, counts)
+
+    async def process_spider_output_async(self, response, result, spider=None):
+        counts = {}
+        elapsed = 0.0
+        result = result.__aiter__()
+        while True:
+            started = time.perf_counter()
+            try:
+                i = await result.__anext__()
+            except StopAsyncIteration:
+                break
+            finally:
+                elapsed += time.perf_counter() - started
+            self.tally(i, counts)
+            yield i
+        self.record(response, elapsed, counts)
+
+    def process_spider_exception(self, response, exception, spider=None):
+        metrics.count(self.crawler.stats, metrics.endpoint(response.request), 'errors', type(exception).__name__)
+        return None
+
+    @staticmethod
+    def tally(item, counts):
+        if isinstance(item, Request):
+            key = ('requests', metrics.endpoint(item))
+        else:
+            key = ('items', type(item).__name__)
+        counts[key] = counts.get(key, 0) + 1
+
+    def record(self, response, elapsed, counts):
+        stats = self.crawler.stats
+        name = metrics.endpoint(response.request)
+        metrics.observe(stats, name, 'parse', elapsed)
+        metrics.observe(stats, name, 'fanout', sum(n for ((kind, _), n) in counts.items() if kind == 'requests'))
+        for ((kind, label), n) in counts.items():
+            metrics.count(stats, name, kind, label, n)
+
+
+class MetricsMiddleware(object):
+    """
+    Records download latency, response size and download errors (exceptions and HTTP errors) per endpoint. Responses
+    served by the HTTP cache are not recorded.
+    """
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('METRICS_ENABLED'):
+            raise NotConfigured
+        return cls(crawler)
+
+    def process_response(self, request, response, spider=None):
+        if 'cached' in response.flags:
+            return response
+        stats = self.crawler.stats
+        name = metrics.endpoint(request)
+        if 'download_latency' in request.meta:
+            metrics.observe(stats, name, 'latency', request.meta['download_latency'])
+        metrics.observe(stats, name, 'size', len(response.body))
+        if response.status >= 400:
+            metrics.count(stats, name, 'errors', 'http_%d' % response.status)
+        return response
+
+    def process_exception(self, request, exception, spider=None):
+        metrics.count(self.crawler.stats, metrics.endpoint(request), 'errors', type(exception).__name__)
+        return None
+
+
+class AdaptiveConcurrencyMiddleware(object):
+    """
+    Gives every endpoint (Meta.name) its own downloader slot and adapts the slot's concurrency window to the observed
+    latency and error rate: the window grows additively while responses stay below the target latency of the endpoint
+    kind and shrinks multiplicatively on errors and slow responses. Once the window is down to one request, the slot
+    delay is doubled instead.
+
+    Endpoint kinds are 'html' for the heavy cbGrid/index pages and 'json' for everything else.
+    """
+
+    def __init__(self, crawler, start_window, max_window, target_latency, backoff, max_delay):
+        self.crawler = crawler
+        self.start_window = start_window
+        self.max_window = max_window
+        self.target_latency = target_latency
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.windows = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('ADAPTIVE_CONCURRENCY_ENABLED'):
+            raise NotConfigured
+        return cls(crawler, settings.getdict('ADAPTIVE_START_WINDOW'), settings.getdict('ADAPTIVE_MAX_WINDOW'),
+                   settings.getdict('ADAPTIVE_TARGET_LATENCY'), settings.getfloat('ADAPTIVE_BACKOFF'),
+                   settings.getfloat('ADAPTIVE_MAX_DELAY'))
+
+    def process_request(self, request, spider=None):
+        meta = request.meta.get('meta')
+        if meta is None or 'download_slot' in request.meta:
+            return None
+
+        key = '%s/%s' % (urlparse_cached(request).hostname, meta.name)
+        request.meta['download_slot'] = key
+        if key not in self.windows:
+            self.windows[key] = float(self.start_window[self.kind(meta.name)])
+            self.apply(key, 0)
+        return None
+
+    def process_response(self, request, response, spider=None):
+        key = request.meta.get('download_slot')
+        if key in self.windows:
+            latency = request.meta.get('download_latency')
+            if response.status >= 500 or response.status == 429:
+                self.decrease(key, 'error')
+            elif latency is not None:
+                target = float(self.target_latency[self.kind(request.meta['meta'].name)])
+                if latency > 2 * target:
+                    self.decrease(key, 'slow')
+                elif latency <= target:
+                    self.increase(key)
+        return response
+
+    def process_exception(self, request, exception, spider=None):
+        key = request.meta.get('download_slot')
+        if key in self.windows:
+            self.decrease(key, 'error')
+
+    def increase(self, key):
+        slot = self.crawler.engine.downloader.slots.get(key)
+        if slot is not None and slot.delay > 0:
+            self.apply(key, slot.delay / 2 if slot.delay > 0.1 else 0)
+            return
+
+        name = key.split('/', 1)[1]
+        window = self.windows[key]
+        self.windows[key] = min(window + 1 / window, float(self.max_window[self.kind(name)]))
+        self.apply(key, None)
+
+    def decrease(self, key, reason):
+        self.crawler.stats.inc_value('adaptive/%s/backoff/%s' % (key.split('/', 1)[1], reason))
+        window = self.windows[key]
+        if window > 1:
+            self.windows[key] = max(window * self.backoff, 1.0)
+            self.apply(key, None)
+        else:
+            slot = self.crawler.engine.downloader.slots.get(key)
+            delay = slot.delay if slot is not None else 0
+            self.apply(key, min(max(delay * 2, 0.5), self.max_delay))
+
+    def apply(self, key, delay):
+        downloader = self.crawler.engine.downloader
+        concurrency = int(self.windows[key])
+        slot_settings = downloader.per_slot_settings.setdefault(key, {})
+        slot_settings['concurrency'] = concurrency
+        if delay is not None:
+            slot_settings['delay'] = delay
+
+        slot = downloader.slots.get(key)
+        if slot is not None:
+            slot.concurrency = concurrency
+            if delay is not None:
+                slot.delay = delay
+
+        name = key.split('/', 1)[1]
+        self.crawler.stats.set_value('adaptive/%s/window' % name, round(self.windows[key], 2))
+        self.crawler.stats.max_value('adaptive/%s/window_max' % name, concurrency)
+        self.crawler.stats.set_value('adaptive/%s/delay' % name, slot_settings.get('delay', 0))
+
+    @staticmethod
+    def kind(name):
+        return 'html' if name.endswith('Html') else 'json'
+
+
+class SessionRenewalMiddleware(object):
+    """
+    Detects responses of invalidated sessions (login page or redirect to it), logs the account in again and replays the
+    request with the new session. Requests of an account are held while its login is in progress and requests built
+    with an outdated session are rewritten before they are sent.
+
+    Each expiry leads to a single login, no matter how many requests were in flight. A request is replayed at most
+    SESSION_MAX_RENEWALS times.
+    """
+
+    def __init__(self, crawler, max_renewals):
+        self.crawler = crawler
+        self.max_renewals = max_renewals
+        self.waiting = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('SESSION_RENEWAL_ENABLED'):
+            raise NotConfigured
+        return cls(crawler, crawler.settings.getint('SESSION_MAX_RENEWALS'))
+
+    async def process_request(self, request, spider=None):
+        account = request.meta.get('account')
+        if account is None or 'meta' not in request.meta:
+            return None
+
+        sessions = self.crawler.spider.sessions
+        if account in self.waiting or account not in sessions:
+            await self.renew(account)
+
+        if form_field(request, 'Session') != sessions[account].session:
+            self.crawler.stats.inc_value('session/rewritten')
+            return with_session(request, sessions[account]).replace(dont_filter=True)
+        return None
+
+    async def process_response(self, request, response, spider=None):
+        account = request.meta.get('account')
+        if account is None or 'meta' not in request.meta or not session_expired(response):
+            return response
+
+        self.crawler.stats.inc_value('session/expired')
+
+        # only log in again if the request was sent with the current session, otherwise it was renewed meanwhile and
+        # the expiry does not count against the request
+        session = self.crawler.spider.sessions.get(account)
+        current = session is not None and form_field(request, 'Session') == session.session
+        if session is None or current or account in self.waiting:
+            await self.renew(account)
+
+        renewals = request.meta.get('session_renewals', 0)
+        if current:
+            if renewals >= self.max_renewals:
+                self.crawler.stats.inc_value('session/gave_up')
+                self.crawler.spider.logger.error('Giving up %s, the session of %s expired %d times'
+                                                 % (request.meta['meta'].id, account, renewals + 1))
+                raise IgnoreRequest('Session of %s expired again for %s' % (account, request.meta['meta'].id))
+            renewals += 1
+
+        request = with_session(request, self.crawler.spider.sessions[account]).replace(dont_filter=True)
+        request.meta['session_renewals'] = renewals
+        return request
+
+    async def renew(self, account):
+        if account in self.waiting:
+            d = Deferred()
+            self.waiting[account].append(d)
+            await maybe_deferred_to_future(d)
+            return
+
+        spider = self.crawler.spider
+        self.waiting[account] = []
+        failure = None
+        try:
+            # a cached login would hand out the expired session again
+            request = spider.login_request(account)
+            request.meta['dont_cache'] = True
+            response = await self.crawler.engine.download_async(request)
+            session = spider.session_from_response(response)
+            if session is None:
+                failure = IgnoreRequest('Login of %s failed' % account)
+            else:
+                spider.sessions[account] = session
+                self.crawler.stats.inc_value('session/renewed')
+                spider.logger.info('Renewed session of %s' % account)
+        except Exception as e:
+            failure = IgnoreRequest('Login of %s failed: %s' % (account, e))
+
+        for d in self.waiting.pop(account):
+            if failure is None:
+                d.callback(None)
+            else:
+                d.errback(failure)
+        if failure is not None:
+            raise failure
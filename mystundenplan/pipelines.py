@@ -5,7 +5,329 @@
 # Don't forget to add your pipeline to the ITEM_PIPELINES setting
 # See: http://doc.scrapy.org/en/latest/topics/item-pipeline.html
 
+import json
+import os
+from scrapy import signals
+from scrapy.exceptions import DropItem, NotConfigured
+from twisted.internet import task
+from mystundenplan.changefeed import ChangeFeedStore, calendar_events, calendar_snapshot, diff_calendar, diff_data
+from mystundenplan.events import CALENDAR_VIEWS, INTERNED, parse_event, parse_events
+from mystundenplan.incremental import IncrementalStore, content_hash
+from mystundenplan.items import CalendarEvent, Download, Reference
+from mystundenplan.shards import OPENERS, Shard
+from mystundenplan.spiders.schedule import Branch, Key, entity_meta
+from mystundenplan.spiders.session import Meta
+from mystundenplan.timetable import TimetableStore
+from mystundenplan.workqueue import worker_name
+
+# context keys encoded in the shard paths
+SHARD_KEYS = ('tenant', 'semester')
+
+# stats of a resumed crawl, which skips the downloads completed before the interruption
+RESUME_STATS = ('frontier/skipped', 'frontier/restored')
+
+# stats of requests given up on, so their downloads and those of their subtree are missing from the crawl
+FAILURE_STATS = ('retry/max_reached', 'httperror/response_ignored_count', 'session/gave_up', 'spider_exceptions/count',
+                 'log_count/ERROR')
+
 
 class MystundenplanPipeline(object):
     def process_item(self, item, spider):
         return item
+
+
+class IncrementalPipeline(object):
+    """Drops downloads whose payload did not change since the last run. Entities are keyed by entity_meta."""
+
+    def __init__(self, crawler, store):
+        self.crawler = crawler
+        self.store = store
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('INCREMENTAL_ENABLED'):
+            raise NotConfigured
+        return cls(crawler, IncrementalStore(crawler.settings.get('INCREMENTAL_PATH')))
+
+    def close_spider(self, spider=None):
+        self.store.close()
+
+    def process_item(self, item, spider=None):
+        if not isinstance(item, Download):
+            return item
+
+        meta = entity_meta(item['meta'])
+        if not self.store.update_hash(meta.id, content_hash(item['data'])):
+            self.crawler.stats.inc_value('incremental/unchanged')
+            raise DropItem('Unchanged %s' % meta.id, log_level='DEBUG')
+
+        self.crawler.stats.inc_value('incremental/changed')
+        return item
+
+
+class ShardedExportPipeline(object):
+    """
+    Streams downloads into compressed JSON lines shards per tenant, semester and endpoint:
+
+    [SHARDED_EXPORT_DIR]/[tenant]/[semester]/[name]/[name]-[n].jl.gz
+
+    Tenant, semester and endpoint name are encoded in the path, so each line only holds the remaining context and the
+    data. Interned calendar events go to [tenant]/[semester]/calendarEvent, references to deduplicated downloads to
+    [tenant]/[semester]/reference.
+
+    Processes writing to the same directory add their node name to the file names ([name]-[node]-[n].jl.gz).
+
+    With a publish_interval the shards written to since the last interval are completed every publish_interval
+    seconds, so partial results of a long crawl are available while it runs.
+    """
+
+    def __init__(self, directory, compression, max_bytes, batch_size, node=None, publish_interval=0):
+        self.directory = directory
+        self.node = node
+        self.compression = compression
+        self.max_bytes = max_bytes
+        self.batch_size = batch_size
+        self.publish_interval = publish_interval
+        self.shards = {}
+        self.written = set()
+        self.task = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.get('SHARDED_EXPORT_DIR'):
+            raise NotConfigured
+
+        compression = settings.get('SHARDED_EXPORT_COMPRESSION')
+        if OPENERS.get(compression, (None, None))[1] is None:
+            raise NotConfigured('Compression %s is not available' % compression)
+
+        node = settings.get('SHARDED_EXPORT_NODE')
+        if not node and settings.get('WORKQUEUE_PATH'):
+            node = worker_name(settings)
+        return cls(settings.get('SHARDED_EXPORT_DIR'), compression, settings.getint('SHARDED_EXPORT_MAX_BYTES'),
+                   settings.getint('SHARDED_EXPORT_BATCH_SIZE'), node,
+                   settings.getfloat('SHARDED_EXPORT_PUBLISH_INTERVAL'))
+
+    def open_spider(self, spider=None):
+        if self.publish_interval > 0:
+            self.task = task.LoopingCall(self.publish)
+            self.task.start(self.publish_interval, now=False)
+
+    def close_spider(self, spider=None):
+        if self.task is not None and self.task.running:
+            self.task.stop()
+        for shard in self.shards.values():
+            shard.close()
+        self.shards = {}
+
+    def publish(self):
+        for key in self.written:
+            self.shards[key].publish()
+        self.written = set()
+
+    def process_item(self, item, spider=None):
+        if isinstance(item, CalendarEvent):
+            event = dict(item)
+            key = (event.pop('tenant') or '_', event.pop('semester') or '_', 'calendarEvent')
+            self.shard(key).write(json.dumps(event, ensure_ascii=False, separators=(',', ':')))
+            return item
+        if isinstance(item, Reference):
+            meta = item['meta']
+            key = (meta.context.get('tenant', '_'), meta.context.get('semester', '_'), 'reference')
+            rest = {k: v for (k, v) in meta.context.items() if k not in SHARD_KEYS}
+            self.shard(key).write(json.dumps({'name': meta.name, 'context': rest, 'ref': item['ref']},
+                                             ensure_ascii=False, separators=(',', ':')))
+            return item
+        if not isinstance(item, Download):
+            return item
+
+        meta = item['meta']
+        context = meta.context
+        key = (context.get('tenant', '_'), context.get('semester', '_'), meta.name)
+        rest = {k: v for (k, v) in context.items() if k not in SHARD_KEYS}
+        self.shard(key).write(json.dumps({'context': rest, 'data': item['data']}, ensure_ascii=False,
+                                         separators=(',', ':')))
+        return item
+
+    def shard(self, key):
+        self.written.add(key)
+        shard = self.shards.get(key)
+        if shard is None:
+            name = '%s-%s' % (key[-1], self.node) if self.node else key[-1]
+            shard = Shard(os.path.join(self.directory, *key, name), self.compression, self.max_bytes,
+                          self.batch_size)
+            self.shards[key] = shard
+        return shard
+
+
+class TimetablePipeline(object):
+    """
+    Normalizes the events of class, location and personal calendars into the timetable store. Events found in several
+    views are stored once and linked to each of them. Views are identified by the id of entity_meta, so a shared class
+    keeps its view whichever course fetched it.
+    """
+
+    def __init__(self, store, commit_interval):
+        self.store = store
+        self.commit_interval = commit_interval
+        self.pending = 0
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.get('TIMETABLE_PATH'):
+            raise NotConfigured
+        return cls(TimetableStore(crawler.settings.get('TIMETABLE_PATH')),
+                   crawler.settings.getint('TIMETABLE_COMMIT_INTERVAL'))
+
+    def close_spider(self, spider=None):
+        self.store.close()
+
+    def process_item(self, item, spider=None):
+        if isinstance(item, CalendarEvent):
+            self.store.put_event(item['tenant'], item['semester'],
+                                 parse_event(item['data'], item['tenant'], item['semester']))
+            return item
+        if isinstance(item, Reference) and item['meta'].name in CALENDAR_VIEWS:
+            # the view of the referenced download, which is the same entity
+            meta = entity_meta(item['meta'])
+            if Key.COURSE in meta.context:
+                self.store.add_parent(meta.id, Key.COURSE, meta.context[Key.COURSE])
+            return item
+        if not isinstance(item, Download) or item['meta'].name not in CALENDAR_VIEWS:
+            return item
+
+        meta = entity_meta(item['meta'])
+        context = meta.context
+        refs = [(kind, context[kind]) for kind in (CALENDAR_VIEWS[meta.name], Key.COURSE) if kind in context]
+        if INTERNED in item['data']:
+            self.store.link_view(meta.id, refs, item['data'][INTERNED])
+        else:
+            self.store.replace_view(meta.id, context.get('tenant'), context.get(Key.SEMESTER), refs,
+                                    parse_events(item['data'], context.get('tenant'), context.get(Key.SEMESTER)))
+
+        self.pending += 1
+        if self.pending >= self.commit_interval:
+            self.store.commit()
+            self.pending = 0
+        return item
+
+
+class ChangeFeedPipeline(object):
+    """
+    Compares each download with the snapshot of its Meta.id from the previous crawl (CHANGEFEED_SNAPSHOT_PATH) and
+    appends the differences as JSON lines to CHANGEFEED_PATH: one added, removed or modified record per event for
+    calendar endpoints and one record per download for all others. Entities reachable through several parents are
+    identified by the id of entity_meta, so their records do not depend on the parent that fetched them.
+
+    Downloads missing from a finished crawl of all branches are reported as removed, as long as their tenant, semester
+    and user were crawled. Crawls that were resumed or gave up on any request do not report removals.
+    """
+
+    def __init__(self, crawler, store, path, commit_interval):
+        self.crawler = crawler
+        self.store = store
+        self.path = path
+        self.commit_interval = commit_interval
+        self.pending = 0
+        self.file = None
+        self.seen = set()
+        self.scopes = set()
+        self.interned = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.get('CHANGEFEED_PATH'):
+            raise NotConfigured
+        s = cls(crawler, ChangeFeedStore(settings.get('CHANGEFEED_SNAPSHOT_PATH')), settings.get('CHANGEFEED_PATH'),
+                settings.getint('CHANGEFEED_COMMIT_INTERVAL'))
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    def process_item(self, item, spider=None):
+        if isinstance(item, CalendarEvent):
+            self.interned[item['key']] = item['data']
+            return item
+        if isinstance(item, Reference):
+            # the entity was fetched through another parent, its download is not missing
+            self.seen.add(entity_meta(item['meta']).id)
+            return item
+        if not isinstance(item, Download):
+            return item
+
+        meta = entity_meta(item['meta'])
+        context = meta.context
+        self.seen.add(meta.id)
+        self.scopes.add((context.get('tenant'), context.get(Key.SEMESTER), context.get('username')))
+
+        calendar = meta.name in CALENDAR_VIEWS
+        if calendar:
+            snapshot = calendar_snapshot(calendar_events(item['data'], context.get('tenant'), context.get(Key.SEMESTER),
+                                                         self.interned))
+        else:
+            snapshot = item['data']
+
+        before = self.store.get(meta.id)
+        if before == snapshot:
+            return item
+        if before is None:
+            self.write('added', meta, data=snapshot)
+        elif calendar:
+            for (op, identity, changes) in diff_calendar(before, snapshot):
+                if op == 'modified':
+                    self.write(op, meta, event=identity, changes=changes)
+                else:
+                    self.write(op, meta, event=identity, data=changes)
+        else:
+            changes = diff_data(before, snapshot)
+            if changes is None:
+                self.write('modified', meta, data=snapshot)
+            else:
+                self.write('modified', meta, changes=changes)
+
+        self.store.put(meta, snapshot)
+        self.pending += 1
+        if self.pending >= self.commit_interval:
+            self.store.commit()
+            self.pending = 0
+        return item
+
+    def write(self, op, meta, **fields):
+        if self.file is None:
+            self.file = open(self.path, 'a', encoding='utf-8')
+        record = {'op': op, 'id': meta.id, 'name': meta.name, 'context': meta.context}
+        record.update(fields)
+        self.file.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n')
+        self.crawler.stats.inc_value('changefeed/%s' % op)
+
+    def complete(self, spider):
+        """
+        Whether the crawl walked all branches without id filters, from the start and without failures, so missing
+        downloads were really removed.
+        """
+        if self.crawler.settings.get('WORKQUEUE_PATH'):
+            return False
+        if any(getattr(spider, name, None) is not None for name in ('courses', 'classes', 'rooms')):
+            return False
+        if set(getattr(spider, 'branches', Branch.ALL)) != set(Branch.ALL):
+            return False
+
+        stats = self.crawler.stats
+        for name in RESUME_STATS + FAILURE_STATS:
+            if stats.get_value(name):
+                spider.logger.info('Not reporting removed downloads, the crawl has %s %s'
+                                   % (name, stats.get_value(name)))
+                return False
+        return True
+
+    def spider_closed(self, spider, reason):
+        if reason == 'finished' and self.complete(spider):
+            removed = self.store.missing(self.scopes, self.seen)
+            for (id_, name, context) in removed:
+                self.write('removed', Meta(id_, name, context))
+            self.store.delete([id_ for (id_, _, _) in removed])
+
+        self.store.close()
+        if self.file is not None:
+            self.file.close()
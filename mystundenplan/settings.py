@@ -24,6 +24,8 @@ ROBOTSTXT_OBEY = False
 LOG_LEVEL = 'INFO'
 
 # Configure maximum concurrent requests performed by Scrapy (default: 16)
+# With adaptive concurrency (below) the per endpoint windows control the load, raise this and
+# CONCURRENT_REQUESTS_PER_DOMAIN (e.g. to 64) so they only bound the requests held by the downloader.
 #CONCURRENT_REQUESTS = 32
 
 # Configure a delay for requests for the same website (default: 0)
@@ -34,6 +36,9 @@ LOG_LEVEL = 'INFO'
 #CONCURRENT_REQUESTS_PER_DOMAIN = 16
 #CONCURRENT_REQUESTS_PER_IP = 16
 
+# Fingerprint requests without their session fields, so they stay duplicates of each other across logins
+REQUEST_FINGERPRINTER_CLASS = 'mystundenplan.frontier.SessionRequestFingerprinter'
+
 # Disable cookies (enabled by default)
 #COOKIES_ENABLED = False
 
@@ -48,27 +53,51 @@ TELNETCONSOLE_ENABLED = False
 
 # Enable or disable spider middlewares
 # See http://scrapy.readthedocs.org/en/latest/topics/spider-middleware.html
-#SPIDER_MIDDLEWARES = {
-#    'mystundenplan.middlewares.MystundenplanSpiderMiddleware': 543,
-#}
+SPIDER_MIDDLEWARES = {
+    'mystundenplan.middlewares.FrontierMiddleware': 100,
+    'mystundenplan.middlewares.WorkQueueMiddleware': 150,
+    'mystundenplan.middlewares.DeduplicationMiddleware': 200,
+    'mystundenplan.middlewares.EventInterningMiddleware': 600,
+    'mystundenplan.middlewares.MetricsSpiderMiddleware': 900,
+}
 
 # Enable or disable downloader middlewares
 # See http://scrapy.readthedocs.org/en/latest/topics/downloader-middleware.html
-#DOWNLOADER_MIDDLEWARES = {
-#    'mystundenplan.middlewares.MyCustomDownloaderMiddleware': 543,
-#}
+DOWNLOADER_MIDDLEWARES = {
+    'mystundenplan.middlewares.IncrementalMiddleware': 50,
+    # above HttpCacheMiddleware (900), so pages of expired sessions are renewed before they could be cached
+    'mystundenplan.middlewares.SessionRenewalMiddleware': 950,
+    'mystundenplan.middlewares.AdaptiveConcurrencyMiddleware': 850,
+    # network side of HttpCacheMiddleware (900): measures the responses of the site, cache hits are not recorded
+    'mystundenplan.middlewares.MetricsMiddleware': 910,
+}
 
 # Enable or disable extensions
 # See http://scrapy.readthedocs.org/en/latest/topics/extensions.html
-#EXTENSIONS = {
-#    'scrapy.extensions.telnet.TelnetConsole': None,
-#}
+EXTENSIONS = {
+    'mystundenplan.metrics.MetricsExtension': 500,
+}
 
 # Configure item pipelines
 # See http://scrapy.readthedocs.org/en/latest/topics/item-pipeline.html
-#ITEM_PIPELINES = {
-#    'mystundenplan.pipelines.MystundenplanPipeline': 300,
-#}
+ITEM_PIPELINES = {
+    'mystundenplan.pipelines.ChangeFeedPipeline': 50,
+    'mystundenplan.pipelines.IncrementalPipeline': 100,
+    'mystundenplan.pipelines.TimetablePipeline': 700,
+    'mystundenplan.pipelines.ShardedExportPipeline': 800,
+}
+
+# Adaptive per endpoint concurrency (disabled by default, replaces AutoThrottle)
+# Each endpoint gets its own downloader slot. Windows start at ADAPTIVE_START_WINDOW, grow by one request per window
+# of responses faster than ADAPTIVE_TARGET_LATENCY (seconds) up to ADAPTIVE_MAX_WINDOW and are multiplied by
+# ADAPTIVE_BACKOFF on errors and responses slower than twice the target. Windows and backoffs are exposed as
+# adaptive/[name]/* stats.
+#ADAPTIVE_CONCURRENCY_ENABLED = True
+ADAPTIVE_START_WINDOW = {'json': 8, 'html': 2}
+ADAPTIVE_MAX_WINDOW = {'json': 32, 'html': 8}
+ADAPTIVE_TARGET_LATENCY = {'json': 1.0, 'html': 3.0}
+ADAPTIVE_BACKOFF = 0.5
+ADAPTIVE_MAX_DELAY = 30
 
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See http://doc.scrapy.org/en/latest/topics/autothrottle.html
@@ -85,8 +114,107 @@ TELNETCONSOLE_ENABLED = False
 
 # Enable and configure HTTP caching (disabled by default)
 # See http://scrapy.readthedocs.org/en/latest/topics/downloader-middleware.html#httpcache-middleware-settings
+# Responses are fingerprinted without the session fields. Set HTTPCACHE_IGNORE_MISSING to replay a cached crawl
+# without any network access.
 #HTTPCACHE_ENABLED = True
 #HTTPCACHE_EXPIRATION_SECS = 0
 #HTTPCACHE_DIR = 'httpcache'
 #HTTPCACHE_IGNORE_HTTP_CODES = []
-#HTTPCACHE_STORAGE = 'scrapy.extensions.httpcache.FilesystemCacheStorage'
+#HTTPCACHE_IGNORE_MISSING = True
+HTTPCACHE_STORAGE = 'mystundenplan.httpcache.SqliteCacheStorage'
+
+# Enable and configure incremental recrawls (disabled by default)
+# Responses younger than the TTL of their endpoint are served from the local store and downloads are only emitted
+# when their payload changed. Endpoints without TTL entry inherit the TTL of their parent in the traversal tree.
+#INCREMENTAL_ENABLED = True
+INCREMENTAL_PATH = 'incremental.db'
+INCREMENTAL_TTL_DEFAULT = 0
+INCREMENTAL_TTL = {
+    'semesterJson': 24 * 60 * 60,
+    'indexHtml': 6 * 60 * 60,
+    'courseSelectionJson': 0,
+    'personalCalendarHtml': 24 * 60 * 60,
+    'personalCalendarJson': 0,
+    'classCalendarJson': 0,
+    'locationCalendarJson': 0,
+}
+
+# Enable and configure the sharded export (disabled by default)
+# Downloads are streamed into [dir]/[tenant]/[semester]/[name]/[name]-[n].jl[.gz|.zst] files. Compression is one of
+# 'none', 'gzip' or 'zstd' (Python 3.14 or backports.zstd). Shards rotate after SHARDED_EXPORT_MAX_BYTES of
+# uncompressed data and are written in batches of SHARDED_EXPORT_BATCH_SIZE lines. Files carry a .part suffix until
+# they are complete: every SHARDED_EXPORT_PUBLISH_INTERVAL seconds, or only at rotation and at the end with 0.
+#SHARDED_EXPORT_DIR = 'export'
+SHARDED_EXPORT_COMPRESSION = 'gzip'
+SHARDED_EXPORT_MAX_BYTES = 64 * 1024 * 1024
+SHARDED_EXPORT_BATCH_SIZE = 100
+SHARDED_EXPORT_PUBLISH_INTERVAL = 0
+# Name added to the shard file names, defaults to WORKQUEUE_WORKER in distributed crawls
+#SHARDED_EXPORT_NODE = 'node1'
+
+# Enable the normalized timetable store (disabled by default)
+# Calendar events are deduplicated into an indexed SQLite file, query it with python -m mystundenplan.timetable
+#TIMETABLE_PATH = 'timetable.db'
+TIMETABLE_COMMIT_INTERVAL = 100
+
+# Write a change feed against the previous crawl (disabled by default)
+# Downloads are compared with their last snapshot in CHANGEFEED_SNAPSHOT_PATH, calendars event by event. Added, removed
+# and modified records are appended as JSON lines to CHANGEFEED_PATH.
+#CHANGEFEED_PATH = 'changes.jl'
+CHANGEFEED_SNAPSHOT_PATH = 'changefeed.db'
+CHANGEFEED_COMMIT_INTERVAL = 100
+
+# Emit each calendar event once and replace the events of calendar downloads by references (disabled by default)
+#EVENT_INTERNING_ENABLED = True
+
+# Request priorities, higher first
+# Each endpoint gets its PRIORITY_ENDPOINTS value, requests of the current semester(s) PRIORITY_CURRENT_SEMESTER on top.
+# Discovery comes before the calendars it unlocks, the personal, selection and HTML title pages last.
+PRIORITY_ENDPOINTS = {
+    'semesterJson': 100,
+    'indexHtml': 90,
+    'courseJson': 80,
+    'classCalendarJson': 50,
+    'locationCalendarJson': 50,
+    'personalCalendarJson': 30,
+    'courseSelectionJson': 20,
+    'classSelectionJson': 10,
+    'personalCalendarHtml': 0,
+    'classCalendarHtml': 0,
+    'locationCalendarHtml': 0,
+}
+PRIORITY_CURRENT_SEMESTER = 1000
+
+# Fetch classes listed by several courses once and emit Reference items for the other courses (enabled by default)
+DEDUPLICATION_ENABLED = True
+
+# Log in again and replay requests when a session expires during the crawl (enabled by default)
+SESSION_RENEWAL_ENABLED = True
+SESSION_MAX_RENEWALS = 3
+
+# Record the crawl frontier to resume interrupted crawls (disabled by default)
+# Pending requests are stored without session fields and scheduled again after the next login, requests of completed
+# endpoints are skipped. The store is cleared once a crawl finishes.
+#FRONTIER_PATH = 'frontier.db'
+
+# Distributed crawls (disabled by default)
+# The coordinator logs in, discovers semesters, courses, classes and rooms and pushes the requests of
+# WORKQUEUE_ENDPOINTS to the SQLite queue at WORKQUEUE_PATH. Any number of workers (-s WORKQUEUE_ROLE=worker, same
+# accounts) lease them in batches of WORKQUEUE_BATCH_SIZE. Leases expire after WORKQUEUE_LEASE seconds and are retried
+# WORKQUEUE_MAX_ATTEMPTS times. WORKQUEUE_WORKER names a worker, it defaults to [hostname]-[pid].
+#WORKQUEUE_PATH = 'queue.db'
+WORKQUEUE_ROLE = 'coordinator'
+WORKQUEUE_ENDPOINTS = ['classCalendarJson', 'locationCalendarJson']
+WORKQUEUE_BATCH_SIZE = 100
+WORKQUEUE_LEASE = 300
+WORKQUEUE_MAX_ATTEMPTS = 3
+#WORKQUEUE_WORKER = 'worker1'
+
+# Per endpoint metrics (disabled by default)
+# Download latency, response size, parse time and fan-out histograms plus error, request and item counters per
+# endpoint are kept as metrics/[name]/* stats. Snapshots are written every METRICS_INTERVAL seconds as JSON and/or in
+# the Prometheus text format (e.g. into the node exporter's textfile collector directory).
+#METRICS_ENABLED = True
+#METRICS_JSON_PATH = 'metrics.json'
+#METRICS_PROMETHEUS_PATH = 'mystundenplan.prom'
+METRICS_INTERVAL = 30
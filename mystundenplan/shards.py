@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import gzip
+import os
+
+try:
+    from compression import zstd
+except ImportError:
+    try:
+        from backports import zstd
+    except ImportError:
+        zstd = None
+
+# suffix of files still being written
+PARTIAL = '.part'
+
+OPENERS = {
+    'none': ('', open),
+    'gzip': ('.gz', gzip.open),
+    'zstd': ('.zst', zstd.open if zstd else None),
+}
+
+
+class Shard(object):
+    """
+    JSON lines file series that buffers lines, writes them in batches through a compressing stream and rotates to a new
+    file once max_bytes of uncompressed data have been written.
+
+    Files are written with a .part suffix that is dropped once they are complete, so readers can pick up every file
+    without the suffix while the crawl is running. publish completes the current file early.
+    """
+
+    def __init__(self, path, compression, max_bytes, batch_size):
+        self.path = path
+        self.suffix, self.opener = OPENERS[compression]
+        self.max_bytes = max_bytes
+        self.batch_size = batch_size
+        self.buffer = []
+        self.file = None
+        self.filename = None
+        self.index = 0
+        self.written = 0
+
+    def write(self, line):
+        self.buffer.append(line)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+
+        if self.file is None:
+            self.open()
+        data = ('\n'.join(self.buffer) + '\n').encode('utf-8')
+        self.file.write(data)
+        self.written += len(data)
+        self.buffer = []
+
+        if self.max_bytes and self.written >= self.max_bytes:
+            self.rotate()
+
+    def open(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        while True:
+            filename = '%s-%05d.jl%s' % (self.path, self.index, self.suffix)
+            if not (os.path.exists(filename) or os.path.exists(filename + PARTIAL)):
+                break
+            self.index += 1
+        self.filename = filename
+        self.file = self.opener(filename + PARTIAL, 'wb')
+        self.written = 0
+
+    def rotate(self):
+        self.file.close()
+        os.replace(self.filename + PARTIAL, self.filename)
+        self.file = None
+        self.index += 1
+
+    def publish(self):
+        """Completes the current file with the lines written so far, the next lines go to a new file."""
+        self.flush()
+        if self.file is not None:
+            self.rotate()
+
+    def close(self):
+        self.publish()
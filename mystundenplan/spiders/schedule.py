@@ -1,9 +1,8 @@
 # -*- coding: utf-8 -*-
 import jmespath
 import json
+import mystundenplan.extract as extract
 import mystundenplan.spiders.session as session
-import re
-from scrapy import Selector
 from mystundenplan.items import Download
 
 
@@ -13,9 +12,14 @@ class StplSpider(session.SessionSpider):
 
     Usage:
     scrapy crawl stpl -a tenant='[tenant]' -a username='[username]' -a password='[password]' -o stpl.jl
+    scrapy crawl stpl -a accounts='[accounts.csv|accounts.json]' -o stpl.jl
 
     Tenant is 'fhin' for THI, use your LDAP user credentials to authenticate yourself.
 
+    Several accounts are crawled in one process by passing a file of tenant,username,password lines (CSV) or a JSON
+    list. Each account gets its own session. Tenant wide branches (courses and locations) are only walked by the first
+    account of each tenant that logged in, the personal and selection branches by all of them.
+
     The site will be traversed the following way:
     .
     └── semesterJson
@@ -37,20 +41,103 @@ class StplSpider(session.SessionSpider):
 
     By default this spider will fetch only data from the latest semester. Use the [all] switch to scrape the full data
     set. (-a all=True)
+
+    Targeted crawls restrict the traversal to some branches of the tree (-a branches=course,location,selection,personal)
+    and/or to comma separated ids (-a courses=..., -a classes=..., -a rooms=...). Without explicit branches, id filters
+    select the branches they apply to. Pruned branches are never requested and indexHtml is skipped when all of its
+    active branches are given by explicit ids.
+
+    Incremental recrawls are enabled with -s INCREMENTAL_ENABLED=True. See INCREMENTAL_TTL in the settings for the
+    per-subtree refetch intervals.
+
+    Instead of a single feed (-o stpl.jl) downloads can be streamed into compressed shards per semester and endpoint
+    with -s SHARDED_EXPORT_DIR=[dir].
+
+    Class and location calendar pages only add titles to the calendars. With -a derive_html=True these are taken from
+    courseJson (studiengruppe) and the indexHtml room options (cbraum) instead, the pages are only fetched for ids
+    missing there. Derived downloads are marked with the endpoint they were taken from ('derived').
+
+    Distributed crawls run a coordinator (-s WORKQUEUE_PATH=[queue.db]) doing the login and discovery, and any number
+    of workers (additionally -s WORKQUEUE_ROLE=worker) fetching the class and location calendars it queued. Give each
+    process its own account where the site allows one session per user only.
+
+    Crawls are recorded with -s HTTPCACHE_ENABLED=True and replayed offline by adding -s HTTPCACHE_IGNORE_MISSING=True.
+
+    Interrupted crawls are resumed by running them again with the same -s FRONTIER_PATH=[frontier.db]. Completed
+    endpoints are skipped and the pending requests are sent with the session of the new login.
+
+    With -s CHANGEFEED_PATH=[changes.jl] each crawl appends what changed since the previous one (added, removed or
+    modified events and downloads) to a JSON lines feed, comparing against the snapshots in CHANGEFEED_SNAPSHOT_PATH.
+
+    Requests are scheduled by endpoint (PRIORITY_ENDPOINTS), those of the current semester first
+    (PRIORITY_CURRENT_SEMESTER), so the class and room calendars of the current semester arrive early in long crawls.
+
+    Classes listed by several courses are fetched once, the other courses get a Reference item pointing at the
+    download instead (-s DEDUPLICATION_ENABLED=False fetches them for each course).
+
+    Single endpoints are available to asyncio code without a crawl through mystundenplan.client.StplClient.
     """
 
     name = 'schedule'
 
-    def __init__(self, tenant=None, username=None, password=None, all=False, *args, **kwargs):
+    # parent of each endpoint in the traversal tree
+    tree = {
+        'indexHtml': 'semesterJson',
+        'courseJson': 'indexHtml',
+        'classCalendarHtml': 'courseJson',
+        'classCalendarJson': 'courseJson',
+        'locationCalendarHtml': 'indexHtml',
+        'locationCalendarJson': 'indexHtml',
+        'courseSelectionJson': 'semesterJson',
+        'classSelectionJson': 'courseSelectionJson',
+        'personalCalendarHtml': 'semesterJson',
+        'personalCalendarJson': 'semesterJson',
+    }
+
+    def __init__(self, tenant=None, username=None, password=None, all=False, branches=None, courses=None,
+                 classes=None, rooms=None, derive_html=False, *args, **kwargs):
         super(StplSpider, self).__init__(tenant, username, password, *args, **kwargs)
         self.all = all
+        self.derive_html = str(derive_html).lower() in ('1', 'true', 'yes')  # -a passes strings
+        self.courses = split_arg(courses)
+        self.classes = split_arg(classes)
+        self.rooms = split_arg(rooms)
+
+        self.branches = split_arg(branches)
+        if self.branches is None:
+            self.branches = set()
+            if self.courses is not None or self.classes is not None:
+                self.branches.add(Branch.COURSE)
+            if self.rooms is not None:
+                self.branches.add(Branch.LOCATION)
+            if not self.branches:
+                self.branches = set(Branch.ALL)
+        unknown = self.branches - set(Branch.ALL)
+        if unknown:
+            raise ValueError('Unknown branch(es) %s, expected some of %s' % (sorted(unknown), Branch.ALL))
+
+        self.priorities = {}
+        self.current_priority = 0
+        self.current_semesters = set()
+        self.tenant_accounts = {}
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super(StplSpider, cls).from_crawler(crawler, *args, **kwargs)
+        spider.priorities = crawler.settings.getdict('PRIORITY_ENDPOINTS')
+        spider.current_priority = crawler.settings.getint('PRIORITY_CURRENT_SEMESTER')
+        return spider
 
     def parse(self, response):
-        yield self.semester_json_request(self.scrape_semester_json)
+        yield self.semester_json_request(self.extract_account(response), self.scrape_semester_json)
 
     def scrape_semester_json(self, response):
+        account = self.extract_account(response)
         meta, json_data = self.json_response(response)
 
+        tenant = meta.context['tenant']
+        self.current_semesters.update((tenant, s) for s in jmespath.search('[? isaktuelles ==`true`].id', json_data))
+
         # select semester ids
         if self.all:
             self.logger.info('Start scraping all semesters')
@@ -61,182 +148,220 @@ class StplSpider(session.SessionSpider):
 
         self.log_select(meta, Key.SEMESTER, semesters)
         for semester in semesters:
-            yield self.index_html_request(semester, self.scrape_index_html)
-            yield self.course_selection_json_request(semester, self.scrape_course_selection_json)
-            yield self.personal_calendar_html_request(semester, self.scrape_personal_calendar_html)
-            yield self.personal_calendar_json_request(semester, self.scrape_json)
-
-        yield Download(meta=meta._asdict(), data=json_data)
+            if self.tenant_account(account):
+                if self.index_required():
+                    yield self.index_html_request(account, semester, self.scrape_index_html)
+                else:
+                    yield from self.course_requests(account, semester, self.courses or [])
+                    yield from self.location_requests(account, semester, self.rooms or [])
+            if Branch.SELECTION in self.branches:
+                yield self.course_selection_json_request(account, semester, self.scrape_course_selection_json)
+            if Branch.PERSONAL in self.branches:
+                yield self.personal_calendar_html_request(account, semester, self.scrape_personal_calendar_html)
+                yield self.personal_calendar_json_request(account, semester, self.scrape_json)
+
+        yield Download(meta=meta, data=json_data)
         self.log_done(meta)
 
     def scrape_course_selection_json(self, response):
+        account = self.extract_account(response)
         meta, json_data = self.json_response(response)
 
-        class_s = jmespath.search('*[].*[].*[].*[].*[].*[].studiengruppen_id', json_data)
+        class_s = select(jmespath.search('*[].*[].*[].*[].*[].*[].studiengruppen_id', json_data), self.classes)
         self.log_select(meta, Key.CLASS, class_s)
         for class_ in class_s:
-            yield self.class_selection_json_request(meta.context[Key.SEMESTER], class_, self.scrape_json)
+            yield self.class_selection_json_request(account, meta.context[Key.SEMESTER], class_, self.scrape_json)
 
-        yield Download(meta=meta._asdict(), data=json_data)
+        yield Download(meta=meta, data=json_data)
         self.log_done(meta)
 
     def scrape_index_html(self, response):
-        meta, html_data = self.html_response(response)
+        account = self.extract_account(response)
+        meta = self.extract_meta(response)
+        data, courses = extract.index_html(response.text)
 
         # select course ids (without first -1 value)
-        courses = html_data.css("#cbstg > option:not(:first-child)").css('::attr(value)').extract()
-        self.log_select(meta, Key.COURSE, courses)
-        for course in courses:
-            yield self.course_json_request(meta.context[Key.SEMESTER], course, self.scrape_course_json)
+        if Branch.COURSE in self.branches:
+            courses = select(courses, self.courses)
+            self.log_select(meta, Key.COURSE, courses)
+            yield from self.course_requests(account, meta.context[Key.SEMESTER], courses)
 
         # select location ids (without first -1 value)
-        locations = html_data.css("#cbraum > option:not(:first-child)").css("::attr(value)").extract()
-        self.log_select(meta, Key.LOCATION, locations)
-        for location in locations:
-            yield self.location_calendar_html_request(meta.context[Key.SEMESTER], location, self.scrape_location_calendar_html)
-            yield self.location_calendar_json_request(meta.context[Key.SEMESTER], location, self.scrape_json)
-
-        # ---
-        stundenraster = []
-        for line in html_data.css('head > script:last_child::text').re(r'stundenraster\[\d+\] = \[(.*)\];'):
-            m = re.fullmatch(r'\'(?P<starts>\d{2}.\d{2})\', \'(?P<ends>\d{2}.\d{2})\', \'(?P<slot>\d+)\'', line)
-            if m:
-                stundenraster.append({'slot': m.group('slot'), 'starts': m.group('starts'), 'ends': m.group('ends'), })
-
-        cbraum = []
-        for (i, element) in enumerate(html_data.css("#cbraum > option:not(:first-child)")):
-            cbraum.append({
-                'id': element.css('::attr(value)').extract_first(),
-                'title': element.css('::attr(title)').extract_first(),
-                'name': element.css('::text').extract_first()
-            })
-
-        js_variables = html_data.css('head > script:last_child::text')
-
-        data = {
-            'title': html_data.css('head > title::text').extract_first(),
-            'indexLink': js_variables.re_first(r'indexLink = \'(.*)\';'),
-            'frontendDir': js_variables.re_first(r'frontendDir = \'(.*)\';'),
-            'stplIndexLink': js_variables.re_first(r'STPL.IndexLink = \'(.*)\';'),
-            'vorlesungsanfang': js_variables.re_first(r'Vorlesungsanfang = \'(.*)\';'),
-            'vorlesungsende': js_variables.re_first(r'Vorlesungsende = \'(.*)\';'),
-            'semesteranfang': js_variables.re_first(r'Semesteranfang = \'(.*)\';'),
-            'semesterende': js_variables.re_first(r'Semesterende = \'(.*)\';'),
-            'stundenraster': stundenraster,
-            'cbraum': cbraum
-        }
-        # ---
-        yield Download(meta=meta._asdict(), data=data)
+        if Branch.LOCATION in self.branches:
+            locations = select([location['id'] for location in data['cbraum']], self.rooms)
+            self.log_select(meta, Key.LOCATION, locations)
+            yield from self.location_requests(account, meta.context[Key.SEMESTER], locations,
+                                              {location['id']: location for location in data['cbraum']})
+
+        yield Download(meta=meta, data=data)
         self.log_done(meta)
 
     def scrape_course_json(self, response):
+        account = self.extract_account(response)
         meta, json_data = self.json_response(response)
 
         # select class ids
-        class_s = jmespath.search('*[].studiengruppen_id', json_data)
+        class_s = select(jmespath.search('*[].studiengruppen_id', json_data), self.classes)
+        names = {c.get('studiengruppen_id'): c.get('studiengruppe') for c in jmespath.search('*[]', json_data) or []}
         self.log_select(meta, Key.CLASS, class_s)
+        semester, course = meta.context[Key.SEMESTER], meta.context[Key.COURSE]
         for class_ in class_s:
-            yield self.class_calendar_html_request(meta.context[Key.SEMESTER], meta.context[Key.COURSE], class_,
-                                                   self.scrape_class_calendar_html)
-            yield self.class_calendar_json_request(meta.context[Key.SEMESTER], meta.context[Key.COURSE], class_,
-                                                   self.scrape_json)
-
-        yield Download(meta=meta._asdict(), data=json_data)
+            if self.derive_html and names.get(class_):
+                yield self.derived_download(account, 'classCalendarHtml',
+                                            {Key.SEMESTER: semester, Key.COURSE: course, Key.CLASS: class_},
+                                            {'title': names[class_], 'subtitle': None}, 'courseJson')
+            else:
+                yield self.class_calendar_html_request(account, semester, course, class_,
+                                                       self.scrape_class_calendar_html)
+            yield self.class_calendar_json_request(account, semester, course, class_, self.scrape_json)
+
+        yield Download(meta=meta, data=json_data)
         self.log_done(meta)
 
     def scrape_personal_calendar_html(self, response):
-        meta, html_data = self.html_response(response)
-        yield Download(meta=meta._asdict(), data={'title': html_data.css('#content_title > h2::text').extract_first()})
+        meta = self.extract_meta(response)
+        yield Download(meta=meta, data=extract.personal_calendar_html(response.text))
         self.log_done(meta)
 
     def scrape_class_calendar_html(self, response):
-        meta, html_data = self.html_response(response)
-        yield Download(meta=meta._asdict(), data={
-            'title': html_data.css('#content_title > h2::text').extract_first(),
-            'subtitle': html_data.css('#content_subtitle > div::text').extract_first()
-        })
+        meta = self.extract_meta(response)
+        yield Download(meta=meta, data=extract.class_calendar_html(response.text))
         self.log_done(meta)
 
     def scrape_location_calendar_html(self, response):
-        meta, html_data = self.html_response(response)
-        yield Download(meta=meta._asdict(), data={
-            'title': html_data.css('#content_title > h2::text').extract_first(),
-            'subtitle': html_data.css('#content_subtitle > div > div:nth-child(1)::text').extract_first(),
-            'description': html_data.css('#content_subtitle > div > div:nth-child(2)::text').re_first(
-                r'Beschreibung: (.*)$'),
-            'type': html_data.css('#content_subtitle > div > div:nth-child(3)::text').re_first(r'Raumtyp: (.*)$')
-        })
+        meta = self.extract_meta(response)
+        yield Download(meta=meta, data=extract.location_calendar_html(response.text))
         self.log_done(meta)
 
     def scrape_json(self, response):
         meta, json_data = self.json_response(response)
-        yield Download(meta=meta._asdict(), data=json_data)
+        yield Download(meta=meta, data=json_data)
         self.log_done(meta)
 
     # --- REQUESTS
 
-    def semester_json_request(self, callback):
-        return self.request(self.meta('semesterJson'), form={'mode': 'cbsem'}, callback=callback)
+    def course_requests(self, account, semester, courses):
+        for course in courses:
+            yield self.course_json_request(account, semester, course, self.scrape_course_json)
 
-    def index_html_request(self, semester, callback):
-        return self.request(self.meta('indexHtml', {Key.SEMESTER: semester}), form={'sem': semester},
+    def location_requests(self, account, semester, locations, cbraum=None):
+        """cbraum maps location ids to their indexHtml options, the metadata of derived locationCalendarHtml."""
+        for location in locations:
+            option = (cbraum or {}).get(location)
+            if self.derive_html and option and option.get('name'):
+                yield self.derived_download(account, 'locationCalendarHtml',
+                                            {Key.SEMESTER: semester, Key.LOCATION: location},
+                                            {'title': option['name'], 'subtitle': option['title'], 'description': None,
+                                             'type': None}, 'indexHtml')
+            else:
+                yield self.location_calendar_html_request(account, semester, location,
+                                                          self.scrape_location_calendar_html)
+            yield self.location_calendar_json_request(account, semester, location, self.scrape_json)
+
+    def derived_download(self, account, name, context, data, source):
+        """Download of an HTML endpoint built from the data of source instead of fetching the page."""
+        self.crawler.stats.inc_value('derived_html/%s' % name)
+        data['derived'] = source
+        return Download(meta=self.meta(account, name, context), data=data)
+
+    def semester_json_request(self, account, callback):
+        return self.request(account, self.meta(account, 'semesterJson', show_user=True), form={'mode': 'cbsem'},
                             callback=callback)
 
-    def course_selection_json_request(self, semester, callback):
-        return self.request(self.meta('courseSelectionJson', {Key.SEMESTER: semester}, True), query={'sem': semester},
-                            form={'mode': 'faecherauswahlstg'}, callback=callback)
+    def index_html_request(self, account, semester, callback):
+        return self.request(account, self.meta(account, 'indexHtml', {Key.SEMESTER: semester}),
+                            form={'sem': semester}, callback=callback)
 
-    def personal_calendar_html_request(self, semester, callback):
-        return self.request(self.meta('personalCalendarHtml', {Key.SEMESTER: semester}, True), query={'sem': semester},
-                            form={'mode': 'cbGrid'}, callback=callback)
+    def course_selection_json_request(self, account, semester, callback):
+        return self.request(account, self.meta(account, 'courseSelectionJson', {Key.SEMESTER: semester}, True),
+                            query={'sem': semester}, form={'mode': 'faecherauswahlstg'}, callback=callback)
+
+    def personal_calendar_html_request(self, account, semester, callback):
+        return self.request(account, self.meta(account, 'personalCalendarHtml', {Key.SEMESTER: semester}, True),
+                            query={'sem': semester}, form={'mode': 'cbGrid'}, callback=callback)
 
-    def personal_calendar_json_request(self, semester, callback):
-        return self.request(self.meta('personalCalendarJson', {Key.SEMESTER: semester}, True),
+    def personal_calendar_json_request(self, account, semester, callback):
+        return self.request(account, self.meta(account, 'personalCalendarJson', {Key.SEMESTER: semester}, True),
                             query={'sem': semester, 'method': 'list'},
                             form={'mode': 'calendar'}, callback=callback)
 
-    def class_selection_json_request(self, semester, class_, callback):
-        return self.request(self.meta('classSelectionJson', {Key.SEMESTER: semester, Key.CLASS: class_}), query={'sem': semester},
-                            form={'mode': 'faecherauswahllv', 'faecherauswahlstgru': class_},
+    def class_selection_json_request(self, account, semester, class_, callback):
+        return self.request(account,
+                            self.meta(account, 'classSelectionJson', {Key.SEMESTER: semester, Key.CLASS: class_},
+                                      True),
+                            query={'sem': semester}, form={'mode': 'faecherauswahllv', 'faecherauswahlstgru': class_},
                             callback=callback)
 
-    def course_json_request(self, semester, course, callback):
-        return self.request(self.meta('courseJson', {Key.SEMESTER: semester, Key.COURSE: course}), query={'sem': semester},
-                            form={'mode': 'cbstg', 'stg': course}, callback=callback)
+    def course_json_request(self, account, semester, course, callback):
+        return self.request(account, self.meta(account, 'courseJson', {Key.SEMESTER: semester, Key.COURSE: course}),
+                            query={'sem': semester}, form={'mode': 'cbstg', 'stg': course}, callback=callback)
 
-    def location_calendar_html_request(self, semester, location, callback):
-        return self.request(self.meta('locationCalendarHtml', {Key.SEMESTER: semester, Key.LOCATION: location}),
+    def location_calendar_html_request(self, account, semester, location, callback):
+        return self.request(account, self.meta(account, 'locationCalendarHtml',
+                                               {Key.SEMESTER: semester, Key.LOCATION: location}),
                             query={'sem': semester, 'raum': location},
                             form={'mode': 'cbGrid'}, callback=callback)
 
-    def location_calendar_json_request(self, semester, location, callback):
-        return self.request(self.meta('locationCalendarJson', {Key.SEMESTER: semester, Key.LOCATION: location}),
+    def location_calendar_json_request(self, account, semester, location, callback):
+        return self.request(account, self.meta(account, 'locationCalendarJson',
+                                               {Key.SEMESTER: semester, Key.LOCATION: location}),
                             query={'sem': semester, 'method': 'list'}, form={'mode': 'calendar', 'raum': location},
                             callback=callback)
 
-    def class_calendar_html_request(self, semester, course, class_, callback):
-        return self.request(self.meta('classCalendarHtml', {Key.SEMESTER: semester, Key.COURSE: course, Key.CLASS: class_}),
+    def class_calendar_html_request(self, account, semester, course, class_, callback):
+        return self.request(account, self.meta(account, 'classCalendarHtml',
+                                               {Key.SEMESTER: semester, Key.COURSE: course, Key.CLASS: class_}),
                             query={'sem': semester, 'stgru': class_}, form={'mode': 'cbGrid'},
                             callback=callback)
 
-    def class_calendar_json_request(self, semester, course, class_, callback):
-        return self.request(self.meta('classCalendarJson', {Key.SEMESTER: semester, Key.COURSE: course, Key.CLASS: class_}),
+    def class_calendar_json_request(self, account, semester, course, class_, callback):
+        return self.request(account, self.meta(account, 'classCalendarJson',
+                                               {Key.SEMESTER: semester, Key.COURSE: course, Key.CLASS: class_}),
                             query={'sem': semester, 'method': 'list'}, form={'mode': 'calendar', 'stgru': class_},
                             callback=callback)
 
     # --- HELPERS
 
-    def html_response(self, response):
-        return self.extract_meta(response), Selector(text=response.text)
+    def priority(self, meta):
+        """PRIORITY_ENDPOINTS of the endpoint, plus PRIORITY_CURRENT_SEMESTER for requests of a current semester."""
+        priority = int(self.priorities.get(meta.name, 0))
+        if (meta.context.get('tenant'), meta.context.get(Key.SEMESTER)) in self.current_semesters:
+            priority += self.current_priority
+        return priority
+
+    def tenant_account(self, account):
+        """
+        Tenant wide branches (courses and locations) are only walked by the first account of each tenant that got to
+        them, so an account whose login failed never holds them back.
+        """
+        return self.tenant_accounts.setdefault(self.credentials[account].tenant, account) == account
+
+    def index_required(self):
+        return (Branch.COURSE in self.branches and self.courses is None) or \
+               (Branch.LOCATION in self.branches and self.rooms is None)
 
     def json_response(self, response):
         return self.extract_meta(response), json.loads(response.text)
 
     def log_select(self, meta, name, items):
-        self.logger.info('Selected %s %s(s) from %s' % (len(items), name, meta.id))
+        self.logger.debug('Selected %s %s(s) from %s', len(items), name, meta.id)
 
     def log_done(self, meta):
-        self.logger.info('Processed %s', meta.id)
+        self.logger.debug('Processed %s', meta.id)
+
+
+def split_arg(value):
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = value.split(',')
+    return set(v.strip() for v in value if v.strip())
+
+
+def select(ids, allowed):
+    if allowed is None:
+        return ids
+    return [i for i in ids if i in allowed]
 
 
 class Key:
@@ -244,3 +369,40 @@ class Key:
     COURSE = 'course'
     CLASS = 'class'
     LOCATION = 'location'
+
+
+class Branch:
+    COURSE = 'course'
+    LOCATION = 'location'
+    SELECTION = 'selection'
+    PERSONAL = 'personal'
+    ALL = [COURSE, LOCATION, SELECTION, PERSONAL]
+
+
+# endpoints of entities reachable through several parents and the context key of the entity
+ENTITIES = {
+    'classCalendarHtml': Key.CLASS,
+    'classCalendarJson': Key.CLASS,
+    'locationCalendarHtml': Key.LOCATION,
+    'locationCalendarJson': Key.LOCATION,
+}
+
+
+def entity_key(meta):
+    """Identifies what meta fetches independent of the parent it was reached through, None for other endpoints."""
+    kind = ENTITIES.get(meta.name)
+    if kind is None:
+        return None
+    return meta.name, meta.context.get('tenant'), meta.context.get(Key.SEMESTER), meta.context.get(kind)
+
+
+def entity_meta(meta):
+    """
+    meta with an id independent of the parent it was reached through for entity endpoints, e.g. of a class whatever
+    course listed it first, so stores keyed by the id stay stable across crawls. Other metas are returned as they are.
+    """
+    key = entity_key(meta)
+    if key is None:
+        return meta
+    name, tenant, semester, id_ = key
+    return meta._replace(id='%s(%s)' % (name, {'tenant': tenant, Key.SEMESTER: semester, ENTITIES[name]: id_}))
@@ -1,8 +1,16 @@
 # -*- coding: utf-8 -*-
+import csv
+import gzip
+import json
+import re
+import zlib
 import scrapy
 from collections import namedtuple
+from sys import intern
 from scrapy.exceptions import CloseSpider
-from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
+from scrapy.http import TextResponse
+from scrapy.utils.httpobj import urlparse_cached
+from urllib.parse import urlparse, parse_qs, parse_qsl, urlencode, urlunparse
 from w3lib.url import url_query_cleaner
 
 
@@ -10,66 +18,195 @@ def url_create(url, query_data):
     return urlunparse(urlparse(url)._replace(query=urlencode(query_data)))
 
 
+Credentials = namedtuple('Credentials', ['tenant', 'username', 'password'])
+Session = namedtuple('Session', ['url', 'fh', 'lang', 'user', 'session'])
+Meta = namedtuple('Meta', ['id', 'name', 'context'])
+
+SESSION_FIELDS = ('User', 'Session')
+
+# password field of the login page, served instead of the requested page once a session is invalidated
+EXPIRED_PATTERN = re.compile(rb'<input[^>]+name=["\']pwd["\']', re.IGNORECASE)
+
+
+def account_key(credentials):
+    return '%s:%s' % (credentials.tenant, credentials.username)
+
+
+def form_field(request, name):
+    for (k, v) in parse_qsl(request.body.decode('utf-8'), keep_blank_values=True):
+        if k == name:
+            return v
+    return None
+
+
+def without_session(request):
+    form = [(k, v) for (k, v) in parse_qsl(request.body.decode('utf-8'), keep_blank_values=True)
+            if k not in SESSION_FIELDS]
+    return request.replace(body=urlencode(form))
+
+
+def with_session(request, session):
+    form = [(k, v) for (k, v) in parse_qsl(request.body.decode('utf-8'), keep_blank_values=True)
+            if k not in SESSION_FIELDS]
+    form += [('User', session.user), ('Session', session.session)]
+    return request.replace(body=urlencode(form))
+
+
+def decoded_body(response):
+    """
+    Body of response without its gzip or deflate Content-Encoding, which HttpCompressionMiddleware only removes after
+    the middlewares above it saw the response. None if the body can not be decoded.
+    """
+    body = response.body
+    for encoding in reversed(response.headers.getlist('Content-Encoding')):
+        encoding = encoding.strip().lower()
+        try:
+            if encoding in (b'gzip', b'x-gzip'):
+                body = gzip.decompress(body)
+            elif encoding == b'deflate':
+                try:
+                    body = zlib.decompress(body)
+                except zlib.error:
+                    body = zlib.decompress(body, -zlib.MAX_WBITS)  # raw deflate stream
+            elif encoding != b'identity':
+                return None
+        except (OSError, EOFError, zlib.error):
+            return None
+    return body
+
+
+def session_expired(response):
+    """Whether response is the login page, or a redirect to it, that replaces pages of invalidated sessions."""
+    if 300 <= response.status < 400:
+        return b'login.php' in response.headers.get('Location', b'')
+    if urlparse_cached(response).path.endswith('login.php'):
+        return True
+    if not isinstance(response, TextResponse) and not response.headers.get('Content-Encoding'):
+        return False  # encoded bodies are plain Responses until HttpCompressionMiddleware decoded them
+    body = decoded_body(response)
+    return body is not None and EXPIRED_PATTERN.search(body) is not None
+
+
+def load_accounts(accounts):
+    """
+    Reads (tenant, username, password) entries from a JSON file (list of lists or objects), a CSV file or an iterable.
+    """
+    if isinstance(accounts, str):
+        with open(accounts, newline='') as f:
+            if accounts.endswith('.json'):
+                accounts = json.load(f)
+            else:
+                accounts = [row for row in csv.reader(f) if row and not row[0].startswith('#')]
+
+    result = []
+    for entry in accounts:
+        if isinstance(entry, dict):
+            entry = (entry['tenant'], entry['username'], entry['password'])
+        result.append(Credentials(*[str(v).strip() for v in entry]))
+    return result
+
+
 class SessionSpider(scrapy.Spider):
+    """
+    Base spider handling the login of one or more accounts.
+
+    Each account gets its own session, requests carry the key of the account they belong to (see account_key) in their
+    meta and are built with the session of that account.
+    """
+
     VALID_SESSION_LEN = 40
 
     allowed_domains = ['www3.primuss.de']
+    login_url = 'https://www3.primuss.de/stpl/login.php'
 
-    def __init__(self, tenant=None, username=None, password=None, *args, **kwargs):
+    def __init__(self, tenant=None, username=None, password=None, accounts=None, *args, **kwargs):
         super(SessionSpider, self).__init__(*args, **kwargs)
-        Credentials = namedtuple('Credentials', ['tenant', 'username', 'password'])
+        if isinstance(self.allowed_domains, str):
+            self.allowed_domains = self.allowed_domains.split(',')
+
+        self.credentials = {}
         if tenant and username and password:
-            self.credentials = Credentials(tenant, username, password)
+            self.add_account(Credentials(tenant, username, password))
+        if accounts:
+            for credentials in load_accounts(accounts):
+                self.add_account(credentials)
+
+        self.sessions = {}
 
-        self.session = None
+    def add_account(self, credentials):
+        self.credentials[account_key(credentials)] = credentials
+
+    async def start(self):
+        for request in self.start_requests():
+            yield request
 
     def start_requests(self):
         if not self.credentials:
             raise CloseSpider("Credentials missing")
 
-        self.logger.debug('Attempting login with %s' % (self.credentials,))
-        request = scrapy.FormRequest('https://www3.primuss.de/stpl/login.php',
-                                     formdata={'user': self.credentials.username, 'pwd': self.credentials.password,
-                                               'mode': 'login', 'FH': self.credentials.tenant},
-                                     callback=self.store_session_data)
-        return [request]
+        return [self.login_request(account) for account in self.credentials]
 
-    def store_session_data(self, response):
+    def login_request(self, account, callback=None):
+        credentials = self.credentials[account]
+        self.logger.debug('Attempting login with %s' % (account,))
+        return scrapy.FormRequest(self.login_url,
+                                  formdata={'user': credentials.username, 'pwd': credentials.password,
+                                            'mode': 'login', 'FH': credentials.tenant},
+                                  callback=callback or self.store_session_data, meta={'account': account},
+                                  dont_filter=True)
+
+    def session_from_response(self, response):
         query = parse_qs(urlparse(response.url).query)
 
         try:
-            Session = namedtuple('Session', ['url', 'fh', 'lang', 'user', 'session'])
-            session = Session(url_query_cleaner(response.url), query.get('FH')[0], query.get('Lang')[0],
-                              query.get('User')[0], query.get('Session')[0])
-            self.session = session
+            return Session(url_query_cleaner(response.url), query['FH'][0], query['Lang'][0], query['User'][0],
+                           query['Session'][0])
         except KeyError:
-            raise CloseSpider("No valid session found. Please check your credentials!")
+            return None
 
-        self.logger.info('Stored %s' % (self.session,))
+    def store_session_data(self, response):
+        account = self.extract_account(response)
+        session = self.session_from_response(response)
+        if session is None:
+            if len(self.credentials) == 1:
+                raise CloseSpider("No valid session found. Please check your credentials!")
+            self.logger.error('No valid session found for %s. Please check your credentials!' % account)
+            return []
+
+        self.sessions[account] = session
+        self.logger.info('Stored %s for %s' % (session, account))
         return self.parse(response)
 
     def parse(self, response):
         raise NotImplementedError
 
-    def request(self, meta, query=None, form=None, callback=None):
+    def request(self, account, meta, query=None, form=None, callback=None):
+        session = self.sessions[account]
         if query is None: query = {}
         if form is None: form = {}
 
-        query.update({'FH': self.session.fh})
-        form.update({'User': self.session.user, 'Session': self.session.session})
+        query.update({'FH': session.fh})
+        form.update({'User': session.user, 'Session': session.session})
+
+        return scrapy.FormRequest(url_create(session.url, query), formdata=form, callback=callback,
+                                  meta={'meta': meta, 'account': account}, priority=self.priority(meta))
 
-        return scrapy.FormRequest(url_create(self.session.url, query), formdata=form, callback=callback,
-                                  meta={'meta': meta})
+    def priority(self, meta):
+        """Scheduling priority of the request for meta, higher is sent first."""
+        return 0
 
-    def meta(self, name, context=None, show_user=False):
-        meta_context = {'tenant': self.session.fh}
+    def meta(self, account, name, context=None, show_user=False):
+        session = self.sessions[account]
+        meta_context = {'tenant': intern(session.fh)}
         if show_user:
-            meta_context.update({'username': self.session.user})
+            meta_context.update({'username': intern(session.user)})
         if not context is None:
-            meta_context.update(context)
+            meta_context.update((intern(k), intern(v) if isinstance(v, str) else v) for (k, v) in context.items())
 
-        Meta = namedtuple('Meta', ['id', 'name', 'context'])
         return Meta('%s(%s)' % (name, meta_context), name, meta_context)
 
     def extract_meta(self, response):
-        return response.meta['meta']
\ No newline at end of file
+        return response.meta['meta']
+
+    def extract_account(self, response):
+        return response.meta['account']
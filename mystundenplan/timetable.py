@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+Query the normalized timetable store written by TimetablePipeline.
+
+Usage:
+python -m mystundenplan.timetable timetable.db [--semester S] [--room R] [--class C] [--course C] [--user U]
+    [--from 'YYYY-MM-DD HH:MM'] [--to 'YYYY-MM-DD HH:MM'] [--free [--day 08:00-20:00]]
+"""
+import argparse
+import json
+import sqlite3
+from datetime import datetime, timedelta
+from mystundenplan.events import TIME_FORMAT
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS events ('
+    'id INTEGER PRIMARY KEY, key TEXT UNIQUE, tenant TEXT, semester TEXT, title TEXT, starts TEXT, ends TEXT, '
+    'location TEXT, data TEXT)',
+    'CREATE TABLE IF NOT EXISTS occurrences (event INTEGER, view TEXT, kind TEXT, ref TEXT)',
+    'CREATE TABLE IF NOT EXISTS parents (view TEXT, kind TEXT, ref TEXT, PRIMARY KEY (view, kind, ref))',
+    'CREATE INDEX IF NOT EXISTS events_time ON events (semester, starts, ends)',
+    'CREATE INDEX IF NOT EXISTS occurrences_ref ON occurrences (kind, ref, event)',
+    'CREATE INDEX IF NOT EXISTS occurrences_view ON occurrences (view)',
+    'CREATE INDEX IF NOT EXISTS occurrences_event ON occurrences (event)',
+]
+
+EVENT_COLUMNS = ['key', 'tenant', 'semester', 'title', 'starts', 'ends', 'location']
+
+
+class TimetableStore(object):
+    """
+    SQLite store holding each calendar event once, linked to the classes, courses, rooms and users whose calendar
+    views contain it.
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        for statement in SCHEMA:
+            self.connection.execute(statement)
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.execute('DELETE FROM events WHERE id NOT IN (SELECT event FROM occurrences)')
+        self.connection.commit()
+        self.connection.close()
+
+    def put_event(self, tenant, semester, event):
+        self.connection.execute('INSERT INTO events (key, tenant, semester, title, starts, ends, location, data) '
+                                'VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(key) DO NOTHING',
+                                (event.key, tenant, semester, event.title, event.starts, event.ends,
+                                 event.location, json.dumps(event.data, separators=(',', ':'))))
+
+    def link_view(self, view, refs, keys):
+        """
+        Replaces the events of a calendar view. refs are the (kind, ref) pairs every event of the view belongs to, the
+        parents added to the view are linked as well.
+        """
+        refs = list(refs) + self.connection.execute('SELECT kind, ref FROM parents WHERE view = ?', (view,)).fetchall()
+        self.connection.execute('DELETE FROM occurrences WHERE view = ?', (view,))
+        self.connection.executemany('INSERT INTO occurrences (event, view, kind, ref) '
+                                    'SELECT id, ?, ?, ? FROM events WHERE key = ?',
+                                    [(view, kind, ref, key) for key in keys for (kind, ref) in refs])
+
+    def add_parent(self, view, kind, ref):
+        """Links the events of view, now and after it is replaced, to another parent, e.g. a course sharing a class."""
+        self.connection.execute('INSERT OR IGNORE INTO parents (view, kind, ref) VALUES (?, ?, ?)', (view, kind, ref))
+        self.connection.execute('INSERT INTO occurrences (event, view, kind, ref) '
+                                'SELECT DISTINCT event, view, ?, ? FROM occurrences o WHERE view = ? AND NOT EXISTS '
+                                '(SELECT 1 FROM occurrences WHERE view = o.view AND kind = ? AND ref = ?)',
+                                (kind, ref, view, kind, ref))
+
+    def replace_view(self, view, tenant, semester, refs, events):
+        keys = []
+        for event in events:
+            self.put_event(tenant, semester, event)
+            keys.append(event.key)
+        self.link_view(view, refs, keys)
+
+    def events(self, semester=None, starts=None, ends=None, **refs):
+        """Returns events as dicts, filtered by semester, overlap with [starts, ends) and refs like room='...'."""
+        conditions, params = [], []
+        if semester is not None:
+            conditions.append('semester = ?')
+            params.append(semester)
+        if starts is not None:
+            conditions.append('ends > ?')
+            params.append(starts)
+        if ends is not None:
+            conditions.append('starts < ?')
+            params.append(ends)
+        for (kind, ref) in refs.items():
+            if ref is None:
+                continue
+            conditions.append('id IN (SELECT event FROM occurrences WHERE kind = ? AND ref = ?)')
+            params.extend([kind, ref])
+
+        query = 'SELECT %s FROM events' % ', '.join(EVENT_COLUMNS)
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY starts, ends'
+        return [dict(zip(EVENT_COLUMNS, row)) for row in self.connection.execute(query, params)]
+
+    def free(self, starts, ends, day=('08:00', '20:00'), semester=None, **refs):
+        """Returns the (starts, ends) gaps between events in [starts, ends), limited to the daily hours in day."""
+        busy = [(e['starts'], e['ends']) for e in self.events(semester, starts, ends, **refs)]
+        gaps = []
+        date = datetime.strptime(starts, TIME_FORMAT).date()
+        last = datetime.strptime(ends, TIME_FORMAT).date()
+        while date <= last:
+            cursor = max(starts, '%s %s' % (date.isoformat(), day[0]))
+            day_end = min(ends, '%s %s' % (date.isoformat(), day[1]))
+            for (busy_starts, busy_ends) in busy:
+                if busy_ends <= cursor or busy_starts >= day_end:
+                    continue
+                if busy_starts > cursor:
+                    gaps.append((cursor, busy_starts))
+                cursor = max(cursor, busy_ends)
+            if cursor < day_end:
+                gaps.append((cursor, day_end))
+            date += timedelta(days=1)
+        return gaps
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path')
+    parser.add_argument('--semester')
+    parser.add_argument('--room', dest='location')
+    parser.add_argument('--class', dest='class_')
+    parser.add_argument('--course')
+    parser.add_argument('--user')
+    parser.add_argument('--from', dest='starts')
+    parser.add_argument('--to', dest='ends')
+    parser.add_argument('--free', action='store_true', help='print free slots instead of events')
+    parser.add_argument('--day', default='08:00-20:00', help='daily hours considered for free slots')
+    args = parser.parse_args()
+
+    store = TimetableStore(args.path)
+    refs = {'location': args.location, 'class': args.class_, 'course': args.course, 'username': args.user}
+    if args.free:
+        if not (args.starts and args.ends):
+            parser.error('--free requires --from and --to')
+        for (starts, ends) in store.free(args.starts, args.ends, tuple(args.day.split('-')), args.semester, **refs):
+            print('%s - %s' % (starts, ends))
+    else:
+        for event in store.events(args.semester, args.starts, args.ends, **refs):
+            print(json.dumps(event, ensure_ascii=False))
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import os
+import socket
+import sqlite3
+import time
+from mystundenplan.frontier import dump_request, load_request
+
+PENDING, LEASED, DONE, FAILED = 0, 1, 2, 3
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS tasks ('
+    'id TEXT PRIMARY KEY, tenant TEXT, request BLOB, state INTEGER, worker TEXT, expires REAL, attempts INTEGER)',
+    'CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state, tenant, expires)',
+    'CREATE TABLE IF NOT EXISTS discovery (id INTEGER PRIMARY KEY CHECK (id = 0), finished INTEGER)',
+]
+
+
+def worker_name(settings):
+    """Name of this process in the queue and in the shard file names, unique per host and process by default."""
+    return settings.get('WORKQUEUE_WORKER') or '%s-%d' % (socket.gethostname(), os.getpid())
+
+
+class WorkQueue(object):
+    """
+    SQLite queue shared by a coordinator, which pushes requests while it discovers them, and workers leasing them in
+    batches. Requests are stored without session fields, each worker sends them with its own session.
+
+    Leases expire after lease seconds, so requests of a crashed worker are leased again, up to max_attempts times.
+    """
+
+    def __init__(self, path, lease=300, max_attempts=3):
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        for statement in SCHEMA:
+            self.connection.execute(statement)
+        self.lease = lease
+        self.max_attempts = max_attempts
+
+    def close(self):
+        self.connection.close()
+
+    def start_discovery(self):
+        """Starts a new crawl on the queue, the requests of the previous one are dropped so they are fetched again."""
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            self.connection.execute('DELETE FROM tasks')
+            self.connection.execute('INSERT OR REPLACE INTO discovery (id, finished) VALUES (0, 0)')
+            self.connection.execute('COMMIT')
+        except Exception:
+            self.connection.execute('ROLLBACK')
+            raise
+
+    def finish_discovery(self):
+        self.connection.execute('INSERT OR REPLACE INTO discovery (id, finished) VALUES (0, 1)')
+
+    def discovery_finished(self):
+        row = self.connection.execute('SELECT finished FROM discovery').fetchone()
+        return row is not None and row[0] == 1
+
+    def push(self, requests, tenants, spider):
+        """Adds requests (tenants holds the tenant of each), requests already queued are ignored."""
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            self.connection.executemany(
+                'INSERT INTO tasks (id, tenant, request, state, attempts) VALUES (?, ?, ?, ?, 0) '
+                'ON CONFLICT(id) DO NOTHING',
+                [(request.meta['meta'].id, tenant, dump_request(request, spider), PENDING)
+                 for (request, tenant) in zip(requests, tenants)])
+            self.connection.execute('COMMIT')
+        except Exception:
+            self.connection.execute('ROLLBACK')
+            raise
+
+    def lease_requests(self, worker, tenants, size, spider):
+        """Leases up to size pending or expired requests of tenants to worker."""
+        now = time.time()
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            rows = self.connection.execute(
+                'SELECT id, request FROM tasks '
+                'WHERE (state = ? OR (state = ? AND expires < ?)) AND attempts < ? AND tenant IN (%s) LIMIT ?'
+                % ','.join('?' * len(tenants)), [PENDING, LEASED, now, self.max_attempts] + list(tenants) + [size]
+            ).fetchall()
+            self.connection.executemany(
+                'UPDATE tasks SET state = ?, worker = ?, expires = ?, attempts = attempts + 1 WHERE id = ?',
+                [(LEASED, worker, now + self.lease, row[0]) for row in rows])
+            self.connection.execute('COMMIT')
+        except Exception:
+            self.connection.execute('ROLLBACK')
+            raise
+        return [load_request(row[1], spider) for row in rows]
+
+    def done(self, id_):
+        self.connection.execute('UPDATE tasks SET state = ? WHERE id = ?', (DONE, id_))
+
+    def release(self, id_):
+        """Returns a request that could not be fetched to the queue, unless it used up its attempts."""
+        self.connection.execute('UPDATE tasks SET state = CASE WHEN attempts >= ? THEN ? ELSE ? END WHERE id = ?',
+                                (self.max_attempts, FAILED, PENDING, id_))
+
+    def fail_expired(self):
+        """Marks leased requests that expired max_attempts times as failed."""
+        self.connection.execute('UPDATE tasks SET state = ? WHERE state = ? AND expires < ? AND attempts >= ?',
+                                (FAILED, LEASED, time.time(), self.max_attempts))
+
+    def outstanding(self):
+        """Number of requests not done or failed yet."""
+        return self.connection.execute('SELECT COUNT(*) FROM tasks WHERE state IN (?, ?)',
+                                       (PENDING, LEASED)).fetchone()[0]
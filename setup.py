@@ -1,4 +1,4 @@
-from distutils.core import setup
+from setuptools import setup
 
 setup(
     name='mystundenplan-crawler',
@@ -11,6 +11,9 @@ setup(
     description='A web crawler for myStundenplan',
 
     install_requires=[
-        'Scrapy'
-    ]
+        'Scrapy>=2.14'
+    ],
+    extras_require={
+        'client': ['aiohttp>=3.8']
+    }
 )